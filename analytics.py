@@ -0,0 +1,149 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import helper
+import schema
+
+GROUP = ["poolId", "manager"]
+
+
+class Analytics:
+    """Computes manager comparison metrics over the stored history with grouped pandas/NumPy operations:
+    rolling vault token returns, performance relative to holding the tokens (HODL), impermanent loss of
+    the token price move and tick range statistics, per (poolId, manager) and for every window.
+    Metrics of rows whose window lies in the past never change, they are cached on disk and
+    only rows newer than the cache are computed on each run"""
+
+    WINDOWS = {"1d": 86400, "7d": 7 * 86400}
+    CACHE_PATH = os.path.join(helper.ROOT_DIR, '.analytics_cache.pkl')
+
+    def __init__(self, backend, contracts, windows=None, cache_path=None):
+        self.backend = backend
+        self.contracts = contracts
+        self.windows = windows or self.WINDOWS
+        self.cache_path = cache_path or self.CACHE_PATH
+
+    def load_cache(self):
+        try:
+            cache = pd.read_pickle(self.cache_path)
+        except FileNotFoundError:
+            return None
+        if cache.attrs.get("windows") != self.windows:
+            return None
+        return cache
+
+    def compute(self, history=None):
+        """returns the metrics of the full history, computing only rows newer than the cache. Groups with rows up
+        to the newest cached one the cache does not hold, e.g. added by a backfill, are recomputed in full"""
+        if history is None:
+            history = self.backend.read()
+        history = prepare(history)
+        cache = self.load_cache()
+        if cache is not None and not cache.empty:
+            watermark = cache["timestamp"].max()
+            stale = stale_groups(history, cache, watermark)
+            recompute = pd.MultiIndex.from_frame(history[GROUP]).isin(stale)
+            new = (history["timestamp"] > watermark) & ~recompute
+            if not new.any() and not recompute.any():
+                return cache
+            parts = [cache[~pd.MultiIndex.from_frame(cache[GROUP]).isin(stale)]]
+            if recompute.any():
+                print("log: {} groups with rows missing from the analytics cache recomputed".format(len(stale)))
+                parts.append(compute_metrics(history[recompute], self.windows, self.contracts))
+            if new.any():
+                # new rows need the rows of their longest window before them, twice the window covers gaps
+                # between runs
+                lookback = history["timestamp"] >= \
+                    history.loc[new, "timestamp"].min() - 2 * max(self.windows.values())
+                metrics = compute_metrics(history[lookback & ~recompute], self.windows, self.contracts)
+                parts.append(metrics[metrics["timestamp"] > watermark])
+            computed = sum(len(part) for part in parts[1:])
+            metrics = schema.apply(pd.concat(parts, ignore_index=True))
+            metrics = metrics.sort_values(["timestamp"] + GROUP, kind="mergesort").reset_index(drop=True)
+        else:
+            metrics = compute_metrics(history, self.windows, self.contracts)
+            computed = len(metrics)
+        metrics.attrs["windows"] = self.windows
+        metrics.to_pickle(self.cache_path)
+        print("log: metrics of {} rows computed".format(computed))
+        return metrics
+
+
+def prepare(history):
+    """casts the history to the schema, drops rows of failed vaults and sorts it by time"""
+    history = schema.apply(history)
+    if "status" in history.columns:
+        history = history[history["status"].isna() | (history["status"] == "ok")]
+    return history.sort_values(["timestamp"] + GROUP, kind="mergesort").reset_index(drop=True)
+
+
+def stale_groups(history, cache, watermark):
+    """(poolId, manager) of the groups whose history up to the watermark holds other rows than the cache"""
+    counts = history[history["timestamp"] <= watermark].groupby(GROUP, observed=True).size()
+    cached = cache.groupby(GROUP, observed=True).size().reindex(counts.index, fill_value=0)
+    return counts.index[counts != cached]
+
+
+def lagged(df, columns, window):
+    """for every row, the given columns of the last row of the same group at least `window` seconds earlier"""
+    right = df[["timestamp"] + GROUP + columns].copy()
+    right["timestamp"] = right["timestamp"] + window
+    merged = pd.merge_asof(df[["timestamp"] + GROUP], right, on="timestamp", by=GROUP, direction="backward")
+    merged.index = df.index
+    return merged[columns]
+
+
+def decimals_of(df, token, decimals):
+    mapped = df[token + "Contract"].str.lower().map(decimals).astype(float)
+    if token + "Decimals" not in df.columns:
+        return mapped
+    return df[token + "Decimals"].astype(float).fillna(mapped)
+
+
+def compute_metrics(history, windows, contracts):
+    df = history
+    metrics = df[["timestamp"] + GROUP].copy()
+
+    # current pool tick from the token prices, compared with the vault's range
+    # decimals of the rows themselves, older histories without them fall back to the ethereum token map
+    decimals = {contract: values[1] for contract, values in contracts.items()}
+    decimals_0 = decimals_of(df, "token0", decimals)
+    decimals_1 = decimals_of(df, "token1", decimals)
+    price_0_in_1 = df["token0Price"] / df["token1Price"]
+    tick = np.floor(np.log(price_0_in_1 * 10 ** (decimals_1 - decimals_0)) / np.log(1.0001))
+    width = df["upperBound"] - df["lowerBound"]
+    in_range = ((tick >= df["lowerBound"]) & (tick < df["upperBound"])).astype(float)
+    metrics["tick"] = tick
+    metrics["rangeWidthTicks"] = width
+    metrics["rangeWidthPct"] = 1.0001 ** width - 1
+    metrics["inRange"] = in_range
+    metrics["tickDistanceToEdge"] = np.minimum(tick - df["lowerBound"], df["upperBound"] - tick)
+    # share of the vault value in positions in range, over all positions of the vault (histories before the
+    # position decomposition have none)
+    metrics["capitalInRange"] = df["inRangeShare"] if "inRangeShare" in df.columns else np.nan
+
+    # holdings per vault token and running in-range counters for the rolling shares
+    work = df[["timestamp"] + GROUP].copy()
+    work["vaultTokenPrice"] = df["vaultTokenPrice"]
+    work["amount0"] = df["token0Balance"] / df["totalSupply"]
+    work["amount1"] = df["token1Balance"] / df["totalSupply"]
+    work["priceRatio"] = price_0_in_1
+    work["inRangeCount"] = in_range.groupby([df[column] for column in GROUP], observed=True).cumsum()
+    work["rowCount"] = df.groupby(GROUP, observed=True).cumcount() + 1
+
+    for name, window in windows.items():
+        past = lagged(work, ["vaultTokenPrice", "amount0", "amount1", "priceRatio", "inRangeCount", "rowCount"],
+                      window)
+        vault_return = df["vaultTokenPrice"] / past["vaultTokenPrice"] - 1
+        hodl_value = past["amount0"] * df["token0Price"] + past["amount1"] * df["token1Price"]
+        hodl_return = hodl_value / past["vaultTokenPrice"] - 1
+        ratio = price_0_in_1 / past["priceRatio"]
+        metrics["return_" + name] = vault_return
+        metrics["hodlReturn_" + name] = hodl_return
+        metrics["vsHodl_" + name] = (1 + vault_return) / (1 + hodl_return) - 1
+        metrics["impermanentLoss_" + name] = 2 * np.sqrt(ratio) / (1 + ratio) - 1
+        metrics["inRangeShare_" + name] = (work["inRangeCount"] - past["inRangeCount"].fillna(0)) \
+            / (work["rowCount"] - past["rowCount"].fillna(0))
+    return metrics
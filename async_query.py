@@ -0,0 +1,135 @@
+import json
+import asyncio
+import itertools
+from urllib.parse import urlparse
+
+import aiohttp
+from web3 import Web3
+
+import helper
+import query
+from multicall import Multicall, CallFailure
+from telemetry import TELEMETRY
+
+
+class AsyncRpc:
+    """Minimal asynchronous JSON-RPC client on aiohttp, which limits the concurrent requests to each endpoint.
+    Failed requests are retried and fail over like helper.FailoverHTTPProvider, sharing its circuit breakers"""
+
+    MAX_RETRIES = helper.FailoverHTTPProvider.MAX_RETRIES
+
+    def __init__(self, session, endpoints, concurrency):
+        self.session = session
+        self.endpoints = endpoints
+        # every endpoint has its own limit, requests failed over to a backup do not count against the primary
+        self.semaphores = {endpoint: asyncio.Semaphore(concurrency) for endpoint in endpoints}
+        self.ids = itertools.count()
+
+    async def request(self, method, params):
+        payload = {"jsonrpc": "2.0", "id": next(self.ids), "method": method, "params": params}
+        for attempt in range(self.MAX_RETRIES):
+            endpoint = helper.CircuitBreaker.pick(self.endpoints)
+            breaker = helper.CircuitBreaker.get(endpoint)
+            host = urlparse(endpoint).netloc
+            try:
+                async with self.semaphores[endpoint]:
+                    TELEMETRY.count("rpc_requests", endpoint=host, method=method)
+                    with TELEMETRY.span("rpc", endpoint=host, method=method):
+                        async with self.session.post(endpoint, json=payload) as response:
+                            response.raise_for_status()
+                            content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                breaker.failure()
+                if attempt == self.MAX_RETRIES - 1:
+                    raise
+                wait = helper.backoff(attempt)
+                print("log: {} to {} failed, retrying in {:.1f}s ({})".format(method, host, wait, type(e).__name__))
+                TELEMETRY.count("rpc_retries", endpoint=host, method=method)
+                await asyncio.sleep(wait)
+                continue
+            breaker.success()
+            TELEMETRY.count("rpc_bytes_received", len(content), endpoint=host, method=method)
+            body = json.loads(content)
+            break
+        if "error" in body:
+            raise ValueError(body["error"])
+        return body["result"]
+
+    async def block_number(self):
+        return int(await self.request("eth_blockNumber", []), 16)
+
+    async def execute(self, multicall):
+        """asynchronous counterpart of Multicall.execute, which sends all chunks concurrently"""
+        if multicall.block_identifier == "latest":
+            multicall.block_identifier = await self.block_number()
+        block = multicall.block_identifier
+        block_param = hex(block) if isinstance(block, int) else block
+        chunks = multicall.chunks()
+        answers = await asyncio.gather(*[
+            self.request("eth_call", [{"to": Multicall.ADDRESS, "data": multicall.encode(chunk)}, block_param])
+            for chunk in chunks], return_exceptions=True)
+        results = []
+        for chunk, answer in zip(chunks, answers):
+            if isinstance(answer, Exception):
+                print("log: multicall batch of {} calls failed ({})".format(len(chunk), answer))
+                results.extend(CallFailure(call, answer) for call in chunk)
+                continue
+            results.extend(multicall.decode(chunk, Web3.toBytes(hexstr=answer)))
+        print("log: {} calls answered in {} concurrent multicall batches at block {}".format(
+            len(multicall.calls), len(chunks), block))
+        multicall.clear()
+        return results
+
+
+class AsyncQuery(query.Query):
+    """Collects the same dataframe as Query, but fetches pool tokens, prices, vault states and positions concurrently:
+    multicall batches are sent in parallel (at most `concurrency` per endpoint) and prices are fetched
+    as soon as the pool tokens are known, while vault states are still in flight. A run is cancelled
+    once it exceeds `deadline` seconds"""
+
+    CONCURRENCY = 8
+    DEADLINE = 120
+
+    def __init__(self, config, concurrency=None, deadline=None, chain=helper.DEFAULT_CHAIN):
+        super().__init__(config, chain=chain)
+        self.concurrency = concurrency or self.CONCURRENCY
+        self.deadline = deadline or self.DEADLINE
+
+    def compile(self, pools=None):
+        return asyncio.run(asyncio.wait_for(self.compile_async(pools), timeout=self.deadline))
+
+    async def compile_async(self, pools=None):
+        endpoints = self.bc.get_endpoints()
+        timeout = aiohttp.ClientTimeout(total=self.bc.timeout)
+        connector = aiohttp.TCPConnector(limit_per_host=self.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            rpc = AsyncRpc(session, endpoints, self.concurrency)
+            block = await rpc.block_number()
+
+            # pool metadata is only read on the first run, it is cached on disk afterwards
+            loop = asyncio.get_running_loop()
+            pool_metadata = await loop.run_in_executor(None, self.get_pool_metadata, pools)
+
+            # pools and vaults are queued separately, so that prices do not wait for the vault states
+            pool_multicall = Multicall(self.bc.get_w3(), block)
+            state_calls = self.queue_pools(pool_multicall, pools)
+            vault_multicall = Multicall(self.bc.get_w3(), block)
+            vault_calls = self.queue_vaults(vault_multicall, pools)
+
+            async def get_pool_state_and_prices():
+                self.pool_registry.set_state(block, state_calls, await rpc.execute(pool_multicall))
+                tokens = self.tokens_of(pool_metadata)
+                return await loop.run_in_executor(None, self.oracle.get_prices, tokens)
+
+            # the positions are read as soon as the vault states are known, at the same block
+            async def get_vault_states_and_positions():
+                results = await rpc.execute(vault_multicall)
+                position_multicall = Multicall(self.bc.get_w3(), block)
+                position_calls = self.queue_positions(position_multicall, vault_calls, results)
+                return results, position_calls, await rpc.execute(position_multicall)
+
+            prices, (results, position_calls, position_results) = await asyncio.gather(
+                get_pool_state_and_prices(), get_vault_states_and_positions())
+
+        return self.build_df(pool_metadata, prices, vault_calls, results, None, position_calls, position_results,
+                             block)
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from pycoingecko import CoinGeckoAPI
+
+import helper
+import oracle
+import query
+from multicall import Multicall
+from telemetry import TELEMETRY
+
+
+class HistoricalPrices:
+    """USD price series of tokens over a time range, fetched from CoinGecko's market_chart/range
+    once per token and range instead of once per block"""
+
+    def __init__(self, contracts, start, end):
+        self.contracts = contracts
+        self.start = start
+        self.end = end
+        self.series = {}
+
+    def load(self, tokens):
+        cg = CoinGeckoAPI()
+        cg.api_base_url = oracle.CoinGeckoSource.API_URL
+        for token in set(token.lower() for token in tokens) - set(self.series):
+            cg_id = self.contracts.get(token, [None])[0]
+            if cg_id is None:
+                print("log: no coingecko id for {}, no historical prices".format(token))
+                continue
+            # pad the range by a day, so that the first snapshot has a preceding price
+            with TELEMETRY.span("coingecko", method="market_chart/range"):
+                TELEMETRY.count("coingecko_requests", method="market_chart/range")
+                chart = cg.get_coin_market_chart_range_by_id(
+                    id=cg_id, vs_currency='usd', from_timestamp=self.start - 86400, to_timestamp=self.end)
+            prices = np.array(chart['prices'], dtype=float).reshape(-1, 2)
+            self.series[token] = (prices[:, 0] / 1000, prices[:, 1])
+            print("log: {} historical prices of {} retrieved".format(len(prices), cg_id))
+        return
+
+    def at(self, timestamp):
+        """returns an oracle serving the last known price at or before timestamp"""
+        prices = {}
+        for token, (timestamps, values) in self.series.items():
+            index = np.searchsorted(timestamps, timestamp, side='right') - 1
+            if index >= 0:
+                prices[token] = float(values[index])
+        return FixedPrices(prices)
+
+
+class FixedPrices:
+    """oracle interface on top of prices known beforehand"""
+
+    def __init__(self, prices):
+        self.prices = prices
+
+    def get_prices(self, contracts):
+        return {contract.lower(): self.prices[contract.lower()] for contract in contracts
+                if contract.lower() in self.prices}
+
+
+class Backfill:
+    """Replays the vault and pool reads of Query at historical blocks, for every `step` seconds between start and end.
+    Blocks are read in parallel, progress is checkpointed so that an interrupted backfill resumes where it stopped,
+    and rows are written to the same storage as save_df. Vaults failing at a block are retried on resume, up to
+    MAX_ATTEMPTS times, so that vaults which always fail there (e.g. not deployed yet, reverting calls or tokens
+    without price history) do not keep the block from completing. Needs an archive RPC node, blocks before the
+    deployment of Multicall3 are skipped"""
+
+    WORKERS = 4
+    MAX_ATTEMPTS = 3
+    CHECKPOINT_DIR = helper.ROOT_DIR
+
+    def __init__(self, config, start, end, step=3600, workers=None, backend=None, chain=helper.DEFAULT_CHAIN,
+                 checkpoint_path=None):
+        self.query = query.Query(config, chain=chain)
+        self.start = int(start)
+        self.end = int(end)
+        self.step = int(step)
+        self.workers = workers or self.WORKERS
+        self.backend = backend
+        self.checkpoint_path = checkpoint_path or helper.chain_path(os.path.join(
+            self.CHECKPOINT_DIR, '.backfill_{}_{}_{}.json'.format(self.start, self.end, self.step)), self.query.chain)
+        checkpoint = self.read_checkpoint(self.checkpoint_path) or {}
+        # resolved blocks and done snapshots stay valid for later ranges of the same step, those before are dropped
+        self.checkpoint = {
+            "start": self.start, "end": self.end, "step": self.step,
+            "blocks": {key: block for key, block in checkpoint.get("blocks", {}).items() if int(key) >= self.start},
+            "done": [timestamp for timestamp in checkpoint.get("done", []) if timestamp >= self.start],
+            "attempts": {key: vaults for key, vaults in checkpoint.get("attempts", {}).items()
+                         if int(key) >= self.start},
+        }
+
+    @classmethod
+    def last_days(cls, config, days, step=3600, chain=helper.DEFAULT_CHAIN, **kwargs):
+        """backfill of the last `days` days. Its range is kept in one checkpoint per chain, days and step, so that
+        rerunning an interrupted backfill resumes the same range however much later. Once the range is complete,
+        the next run backfills the range up to the current time, skipping snapshots done before"""
+        checkpoint_path = helper.chain_path(os.path.join(
+            cls.CHECKPOINT_DIR, '.backfill_{}d_{}.json'.format(days, step)), chain)
+        checkpoint = cls.read_checkpoint(checkpoint_path)
+        if checkpoint is not None and not checkpoint.get("complete", False):
+            start, end = checkpoint["start"], checkpoint["end"]
+            print("log: resuming backfill from {} to {}".format(start, end))
+        else:
+            end = int(time.time()) // step * step
+            # aligned to the step, so that snapshots of earlier ranges are at the same timestamps
+            start = -(-(end - int(days * 86400)) // step) * step
+        return cls(config, start, end, step=step, chain=chain, checkpoint_path=checkpoint_path, **kwargs)
+
+    @staticmethod
+    def read_checkpoint(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_checkpoint(self):
+        self.checkpoint["complete"] = set(self.timestamps()) <= set(self.checkpoint["done"])
+        helper.write_atomic(self.checkpoint_path, json.dumps(self.checkpoint))
+        return
+
+    def get_blocks(self, timestamps):
+        """resolves the block at or before every timestamp through the explorer, known blocks come from the checkpoint"""
+        api = helper.EvmAPI(self.query.bc.blockchain)
+        for timestamp in timestamps:
+            if str(timestamp) not in self.checkpoint["blocks"]:
+                self.checkpoint["blocks"][str(timestamp)] = api.get_block_by_time(timestamp)
+                self.save_checkpoint()
+        return {timestamp: self.checkpoint["blocks"][str(timestamp)] for timestamp in timestamps}
+
+    def timestamps(self):
+        return list(range(self.start, self.end + 1, self.step))
+
+    def get_prices(self):
+        """loads the price series of all pool tokens"""
+        prices = HistoricalPrices(self.query.token_registry.tokens, self.start, self.end)
+        prices.load(self.query.tokens_of(self.query.get_pool_metadata()))
+        return prices
+
+    def snapshot(self, timestamp, block, prices):
+        return self.query.compile(block_identifier=block, timestamp=timestamp, price_oracle=prices.at(timestamp))
+
+    def run(self):
+        """collects all missing snapshots and returns the number of snapshots written"""
+        start_time = time.time()
+        done = set(self.checkpoint["done"])
+        timestamps = [timestamp for timestamp in self.timestamps() if timestamp not in done]
+        print("log: backfilling {} snapshots, {} already done".format(
+            len(timestamps), len(self.timestamps()) - len(timestamps)))
+        if not timestamps:
+            self.save_checkpoint()
+            return 0
+        with TELEMETRY.span("phase", phase="backfill_blocks"):
+            blocks = self.get_blocks(timestamps)
+        deployment = Multicall.DEPLOYMENT_BLOCKS.get(self.query.chain, 0)
+        early = [timestamp for timestamp in timestamps if blocks[timestamp] < deployment]
+        if early:
+            print("log: {} snapshots before the deployment of multicall3 at block {} skipped".format(
+                len(early), deployment))
+            self.checkpoint["done"].extend(early)
+            self.save_checkpoint()
+            timestamps = [timestamp for timestamp in timestamps if blocks[timestamp] >= deployment]
+            if not timestamps:
+                return 0
+        with TELEMETRY.span("phase", phase="backfill_prices"):
+            prices = self.get_prices()
+
+        written = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.snapshot, timestamp, blocks[timestamp], prices): timestamp
+                       for timestamp in timestamps}
+            for future in as_completed(futures):
+                timestamp = futures[future]
+                try:
+                    df = future.result()
+                except Exception as e:
+                    print("log: snapshot at block {} failed, it is retried on resume ({})".format(blocks[timestamp], e))
+                    continue
+                # rows are written from this thread only, failed vaults are left for the next resume,
+                # as the storage would skip their retried rows otherwise
+                ok = df["status"] == "ok"
+                if ok.any():
+                    with TELEMETRY.span("phase", phase="storage"):
+                        self.backend.append(df[ok])
+                if not ok.all() and self.retry(timestamp, blocks[timestamp], df[~ok]):
+                    self.save_checkpoint()
+                    continue
+                self.checkpoint["done"].append(timestamp)
+                self.checkpoint["attempts"].pop(str(timestamp), None)
+                self.save_checkpoint()
+                written += 1
+        self.save_checkpoint()
+        print("log: backfilled {} snapshots in {:.1f}s".format(written, time.time() - start_time))
+        return written
+
+    def retry(self, timestamp, block, failed):
+        """counts the failed attempts of the failed vaults at timestamp, returns whether any of them is retried.
+        Vaults that failed MAX_ATTEMPTS times are given up at that timestamp"""
+        attempts = self.checkpoint["attempts"].setdefault(str(timestamp), {})
+        retried = 0
+        for str_pool, str_manager in zip(failed["poolId"], failed["manager"]):
+            key = "{} {}".format(str_pool, str_manager)
+            attempts[key] = attempts.get(key, 0) + 1
+            retried += attempts[key] < self.MAX_ATTEMPTS
+        if retried:
+            print("log: {} vaults at block {} failed, they are retried on resume".format(retried, block))
+        if len(failed) - retried:
+            print("log: {} vaults at block {} failed {} times, they are given up".format(
+                len(failed) - retried, block, self.MAX_ATTEMPTS))
+        return bool(retried)
@@ -0,0 +1,613 @@
+import json
+import math
+import os
+import sys
+import random
+import decimal
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import wait
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import requests
+import urllib3
+
+import async_query
+import helper
+import incremental
+import numeric
+import positions
+import query
+import schema
+import tokens
+import replay
+from fake_rpc import FakeChain, point_to, route
+from multicall import Multicall
+from telemetry import TELEMETRY
+from web3 import Web3
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(ROOT_DIR, 'query_config.json')
+# results of the last bench_scale run, later runs are compared against them
+BASELINE_PATH = os.path.join(ROOT_DIR, '.bench_baseline.json')
+# factor by which a time or memory result may exceed the baseline before it counts as a regression
+TOLERANCE = 1.25
+# compile run of query_config.json recorded with replay.py, and the snapshot the per-manager vault methods
+# made of it before the adapter specs replaced them
+ADAPTERS_FIXTURE_PATH = os.path.join(ROOT_DIR, 'fixtures', 'adapters.json')
+ADAPTERS_EXPECTED_PATH = os.path.join(ROOT_DIR, 'fixtures', 'adapters_expected.csv')
+
+# token addresses of the symbols used in the pool ids of query_config.json
+SYMBOLS = {
+    "usdc": "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48",
+    "usdt": "0xdac17f958d2ee523a2206206994597c13d831ec7",
+    "eth": "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2",
+    "dai": "0x6b175474e89094c44da98b954eedeac495271d0f",
+    "wbtc": "0x2260fac5e5542a773aa44fbcfedf7c193bc2c599",
+    "ens": "0xc18360217d8f7ab5e7c516566761ea12ce7f9d72",
+    "link": "0x514910771af9ca656af840dff83e8264ecf986ca",
+}
+
+# output types of every function a vault method reads
+OUTPUTS = {
+    "decimals": (["uint8"], [18]),
+    "totalSupply": (["uint256"], [10 ** 21]),
+    "getUnderlyingBalances": (["uint256", "uint256"], [10 ** 12, 10 ** 20]),
+    "getTotalAmounts": (["uint256", "uint256"], [10 ** 12, 10 ** 20]),
+    "usersAmounts": (["uint256", "uint256"], [10 ** 12, 10 ** 20]),
+    "calculateTotals": (["uint256", "uint256", "uint256", "uint256"], [10 ** 12, 10 ** 20, 0, 0]),
+    "mainPosition": (["int24", "int24"], [-887220, 887220]),
+    "upperTick": (["int24"], [887220]),
+    "lowerTick": (["int24"], [-887220]),
+    "baseUpper": (["int24"], [887220]),
+    "baseLower": (["int24"], [-887220]),
+    "tickUpper": (["int24"], [887220]),
+    "tickLower": (["int24"], [-887220]),
+    "limitUpper": (["int24"], [600]),
+    "limitLower": (["int24"], [60]),
+    "rangePosition": (["int24", "int24"], [-600, -60]),
+}
+
+
+# coingecko ids and decimals of the tokens above
+with open(tokens.TokenRegistry.SEED_PATH, 'r') as f:
+    TOKENS = json.load(f)
+
+SLOT0_OUTPUTS = ["uint160", "int24", "uint16", "uint16", "uint16", "uint8", "bool"]
+POSITION_OUTPUTS = ["uint128", "uint256", "uint256", "uint128", "uint128"]
+TICK_OUTPUTS = ["uint128", "int128", "uint256", "uint256", "int56", "uint160", "uint32", "bool"]
+
+
+def load_config():
+    with open(CONFIG_PATH, 'r') as f:
+        return json.load(f)
+
+
+def synthetic_config(vaults):
+    """config with the given number of vaults, cycling through the pools and managers of query_config.json.
+    Each round over them gets its own pool keys and addresses, so that pools and vaults are all distinct"""
+    config = load_config()
+    base = [(str_pool, str_manager) for str_pool, dict_managers in config['query'].items()
+            for str_manager in dict_managers]
+    synthetic = {"query": {}, "uni_pools": {}}
+    for index in range(vaults):
+        str_pool, str_manager = base[index % len(base)]
+        key = "{}_{}".format(str_pool, index // len(base))
+        synthetic['uni_pools'][key] = Web3.toChecksumAddress(Web3.toHex(Web3.keccak(text=key)[-20:]))
+        synthetic['query'].setdefault(key, {})[str_manager] = Web3.toChecksumAddress(
+            Web3.toHex(Web3.keccak(text=key + str_manager)[-20:]))
+    return synthetic
+
+
+def build_chain(config, latency=0.0):
+    """registers every pool and vault of the config on a local fake chain"""
+    chain = FakeChain(latency=latency)
+    for str_pool, dict_managers in config['query'].items():
+        pool_address = config['uni_pools'][str_pool]
+        symbol_0, symbol_1 = str_pool.split("_")[:2]
+        chain.register(pool_address, "token0", ["address"], [SYMBOLS[symbol_0]])
+        chain.register(pool_address, "token1", ["address"], [SYMBOLS[symbol_1]])
+        chain.register(pool_address, "fee", ["uint24"], [int(float(str_pool.split("_")[2]) * 10000)])
+        chain.register(pool_address, "slot0", SLOT0_OUTPUTS, [2 ** 96, 0, 0, 1, 1, 0, True])
+        chain.register(pool_address, "liquidity", ["uint128"], [10 ** 18])
+        for fn_name, fee_growth in (("feeGrowthGlobal0X128", 3 * 2 ** 128), ("feeGrowthGlobal1X128", 5 * 2 ** 128)):
+            chain.register(pool_address, fn_name, ["uint256"], [fee_growth])
+        for symbol in (symbol_0, symbol_1):
+            cg_id, decimals = TOKENS[SYMBOLS[symbol]]
+            chain.register(SYMBOLS[symbol], "decimals", ["uint8"], [decimals])
+            chain.coins[SYMBOLS[symbol]] = cg_id
+        chain.abis["0x8f8ef111b67c04eb1641f5ff19ee54cda062f163"] = chain.abis[pool_address.lower()]
+        for str_manager, str_contract in dict_managers.items():
+            for fn_name in query.Query.vault_calls(str_manager):
+                chain.register(str_contract, fn_name, *OUTPUTS[fn_name])
+            register_positions(chain, pool_address, str_manager, str_contract)
+            abi_address = query.Query.MANAGERS[str_manager]["abi"]
+            if abi_address is not None:
+                chain.abis[abi_address.lower()] = chain.abis[str_contract.lower()]
+    return chain
+
+
+def register_positions(chain, pool_address, str_manager, str_contract):
+    """registers the uni positions of a vault at the ticks of OUTPUTS, in range positions accrued fees since their
+    last update, all of them hold tokens owed"""
+    state = {fn_name: values[0] if len(values) == 1 else values for fn_name, (types, values) in OUTPUTS.items()}
+    for name, tick_lower, tick_upper in query.Query.decode_positions(str_manager, state):
+        key = positions.position_key(str_contract, tick_lower, tick_upper)
+        chain.register(pool_address, "positions", POSITION_OUTPUTS, [10 ** 15, 0, 0, 10 ** 6, 10 ** 15],
+                       ["bytes32"], [key])
+        for tick in (tick_lower, tick_upper):
+            chain.register(pool_address, "ticks", TICK_OUTPUTS, [0, 0, 2 ** 127, 2 ** 127, 0, 0, 0, True],
+                           ["int24"], [tick])
+    return
+
+
+def check(name, failures):
+    """prints the failures of a bench and returns whether there were any"""
+    for failure in failures:
+        print("bench {}: FAILED, {}".format(name, failure))
+    return bool(failures)
+
+
+def bench_multicall():
+    """counts the eth_calls a compile run sends through multicall against the calls it would make one by one,
+    and checks the request count and the rows against the values the fake chain serves. Returns whether it failed"""
+    config = load_config()
+    chain = build_chain(config).start()
+    point_to(chain)
+
+    start = time.perf_counter()
+    df = query.Query(config).compile()
+    duration = time.perf_counter() - start
+    chain.stop()
+
+    single_calls = 2 * len(config['query']) + sum(
+        len(query.Query.vault_calls(str_manager))
+        for dict_managers in config['query'].values() for str_manager in dict_managers)
+    print("bench multicall: {} vaults, {} single eth_calls replaced by {} eth_call requests, "
+          "{} explorer abi requests in {:.3f}s".format(
+              len(df), single_calls, chain.count("eth_call"), chain.count("getabi"), duration))
+
+    # one eth_call each for the pool metadata, the vault and pool states and the positions
+    failures = [] if chain.count("eth_call") == 3 else [
+        "{} eth_call requests instead of 3".format(chain.count("eth_call"))]
+    vaults = sum(len(dict_managers) for dict_managers in config['query'].values())
+    if len(df) != vaults or not (df["status"] == "ok").all():
+        failures.append("{} ok rows of {} vaults".format(int((df["status"] == "ok").sum()), vaults))
+    decimals_0 = df["token0Contract"].astype(str).str.lower().map(lambda contract: TOKENS[contract][1])
+    decimals_1 = df["token1Contract"].astype(str).str.lower().map(lambda contract: TOKENS[contract][1])
+    balance_0 = OUTPUTS["getTotalAmounts"][1][0] / 10.0 ** decimals_0
+    balance_1 = OUTPUTS["getTotalAmounts"][1][1] / 10.0 ** decimals_1
+    supply = OUTPUTS["totalSupply"][1][0] / 10.0 ** OUTPUTS["decimals"][1][0]
+    expected = {
+        "totalSupply": supply,
+        "token0Balance": balance_0,
+        "token1Balance": balance_1,
+        "vaultValue": (balance_0 + balance_1) * chain.price,
+        "vaultTokenPrice": (balance_0 + balance_1) * chain.price / supply,
+        "upperBound": OUTPUTS["baseUpper"][1][0],
+        "lowerBound": OUTPUTS["baseLower"][1][0],
+    }
+    for column, values in expected.items():
+        values = pd.Series(np.broadcast_to(values, len(df)), index=df.index, dtype=float)
+        wrong = ~np.isclose(df[column].astype(float), values, rtol=1e-12)
+        if wrong.any():
+            failures.append("{} of {} vaults differ, e.g. {} instead of {}".format(
+                column, int(wrong.sum()), df.loc[wrong, column].iloc[0], values[wrong].iloc[0]))
+    return check("multicall", failures)
+
+
+def bench_pool_cache():
+    """counts the pool calls of a first and a second compile run, the second one reads pool metadata from disk.
+    Returns whether the second run did not send fewer eth_calls"""
+    config = load_config()
+    chain = build_chain(config).start()
+    point_to(chain)
+    distinct = len(set(config['uni_pools'][str_pool].lower() for str_pool in config['query']))
+
+    calls = []
+    for run in range(2):
+        chain.reset()
+        query.Query(config).compile()
+        calls.append(chain.count("eth_call"))
+    chain.stop()
+
+    print("bench pool cache: {} config keys on {} distinct pools, {} eth_call requests on the first run, "
+          "{} with cached metadata".format(len(config['query']), distinct, calls[0], calls[1]))
+    return check("pool cache", [] if calls[1] < calls[0] else [
+        "{} eth_call requests with cached metadata, {} without".format(calls[1], calls[0])])
+
+
+def bench_precision(vaults=20000, seed=0):
+    """compares the float conversion of the former vault methods with the exact batch conversion of numeric.py,
+    on random 18 decimal vaults with large supplies, against a reference computed with 200 significant digits.
+    Returns whether an exact price is off by more than one ulp"""
+    rng = random.Random(seed)
+    batch = [
+        [rng.randrange(10 ** 24, 10 ** 27) for _ in range(vaults)],
+        [18] * vaults,
+        [rng.randrange(10 ** 20, 10 ** 26) for _ in range(vaults)],
+        [18] * vaults,
+        [rng.uniform(0.01, 5000) for _ in range(vaults)],
+        [rng.randrange(10 ** 8, 10 ** 14) for _ in range(vaults)],
+        [6] * vaults,
+        [rng.uniform(0.99, 1.01) for _ in range(vaults)],
+    ]
+
+    start = time.perf_counter()
+    float_prices = []
+    for supply, decimals, balance_0, decimals_0, price_0, balance_1, decimals_1, price_1 in zip(*batch):
+        total_supply = supply / (10 ** decimals)
+        vault_value = balance_0 / (10 ** decimals_0) * price_0 + balance_1 / (10 ** decimals_1) * price_1
+        float_prices.append(vault_value / total_supply)
+    float_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exact_prices = numeric.vault_values(*batch)["vaultTokenPrice"]
+    exact_duration = time.perf_counter() - start
+
+    with decimal.localcontext() as context:
+        context.prec = 200
+        reference = [
+            (Decimal(balance_0) / 10 ** decimals_0 * Decimal(repr(price_0))
+             + Decimal(balance_1) / 10 ** decimals_1 * Decimal(repr(price_1))) / (Decimal(supply) / 10 ** decimals)
+            for supply, decimals, balance_0, decimals_0, price_0, balance_1, decimals_1, price_1 in zip(*batch)]
+    errors = {}
+    for name, prices in (("float", float_prices), ("exact", exact_prices)):
+        errors[name] = max(abs(Decimal(float(price)) - expected) / expected for price, expected in zip(prices, reference))
+        errors[name + " ulps"] = max(abs(float(price) - float(expected)) / math.ulp(float(expected))
+                                     for price, expected in zip(prices, reference))
+
+    print("bench precision: {} vaults, vault token price max relative error float {:.2e} ({:.0f} ulps) "
+          "in {:.3f}s, exact {:.2e} ({:.0f} ulps) in {:.3f}s".format(
+              vaults, errors["float"], errors["float ulps"], float_duration, errors["exact"], errors["exact ulps"],
+              exact_duration))
+    return check("precision", [] if errors["exact ulps"] <= 1 else [
+        "exact conversion off by {:.0f} ulps".format(errors["exact ulps"])])
+
+
+def bench_schema(rows=100000, seed=0):
+    """loads a history of rows as a storage backend returns it, typing it with convert_dtypes as before
+    and with the explicit casts of the schema, comparing time and memory. Returns whether a column did not get
+    its schema type"""
+    rng = random.Random(seed)
+    config = load_config()
+    vaults = [(str_pool, str_manager) for str_pool, dict_managers in config['query'].items()
+              for str_manager in dict_managers]
+    contracts = list(SYMBOLS.values())
+    records = []
+    for index in range(rows):
+        str_pool, str_manager = vaults[index % len(vaults)]
+        record = {column: rng.uniform(0, 10 ** 6) for column, dtype in schema.SCHEMA.items() if dtype == "float64"}
+        record.update({
+            "timestamp": 1640995200 + index // len(vaults) * 3600,
+            "poolId": str_pool,
+            "manager": str_manager,
+            "token0Contract": contracts[index % 3],
+            "token1Contract": contracts[3 + index % 4],
+            "upperBound": rng.randrange(-887272, 887272),
+            "lowerBound": rng.randrange(-887272, 887272),
+            "totalSupplyRaw": str(rng.randrange(10 ** 24)),
+            "token0BalanceRaw": str(rng.randrange(10 ** 24)),
+            "token1BalanceRaw": str(rng.randrange(10 ** 24)),
+            "vaultDecimals": 18,
+            "token0Decimals": 6,
+            "token1Decimals": 18,
+            "status": "ok",
+        })
+        records.append(record)
+
+    stored = pd.DataFrame(records)
+
+    start = time.perf_counter()
+    inferred = stored.convert_dtypes()
+    inferred_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    typed = schema.apply(stored)
+    typed_duration = time.perf_counter() - start
+
+    print("bench schema: {} rows, convert_dtypes {:.1f} MB in {:.3f}s, schema {:.1f} MB in {:.3f}s".format(
+        rows, inferred.memory_usage(deep=True).sum() / 2 ** 20, inferred_duration,
+        typed.memory_usage(deep=True).sum() / 2 ** 20, typed_duration))
+    return check("schema", ["{} is {} instead of {}".format(column, typed[column].dtype, dtype)
+                            for column, dtype in schema.SCHEMA.items()
+                            if column in typed.columns and typed[column].dtype != dtype])
+
+
+def count_connections(function):
+    """runs function and returns the number of TCP connections opened meanwhile"""
+    counter = [0]
+    connect = urllib3.connection.HTTPConnection.connect
+
+    def counting_connect(self):
+        counter[0] += 1
+        return connect(self)
+
+    urllib3.connection.HTTPConnection.connect = counting_connect
+    try:
+        function()
+    finally:
+        urllib3.connection.HTTPConnection.connect = connect
+    return counter[0]
+
+
+def bench_connections():
+    """counts TCP connections per compile run with ABIs fetched from the explorer,
+    once building providers, contracts and explorer sessions per call as before and once with the registry.
+    Returns whether the registry did not open fewer connections"""
+    config = load_config()
+    chain = build_chain(config).start()
+    point_to(chain)
+    create_contract = helper.Blockchain.create_contract
+    execute = helper.EvmAPI.execute
+
+    def create_contract_per_call(self, *args, **kwargs):
+        helper.Blockchain.reset()
+        return create_contract(self, *args, **kwargs)
+
+    def execute_per_call(self, module_string):
+        helper.EvmAPI.SESSION = requests.Session()
+        return execute(self, module_string)
+
+    def run():
+        helper.ABI_STORE = helper.AbiStore(cache_dir=tempfile.mkdtemp(), use_bundle=False)
+        helper.Blockchain.reset()
+        helper.EvmAPI.SESSION = requests.Session()
+        query.Query(config).compile()
+
+    helper.Blockchain.create_contract = create_contract_per_call
+    helper.EvmAPI.execute = execute_per_call
+    before = count_connections(run)
+    helper.Blockchain.create_contract = create_contract
+    helper.EvmAPI.execute = execute
+    after = count_connections(run)
+    chain.stop()
+
+    print("bench connections: {} TCP connections per compile run before, {} with the provider registry".format(
+        before, after))
+    return check("connections", [] if after < before else [
+        "{} connections with the registry, {} without".format(after, before)])
+
+
+def bench_concurrency(latency=0.05, batch_size=10, concurrency=8):
+    """compares serial and async wall time against a fake chain answering every request after `latency` seconds,
+    with small multicall batches standing in for a config with many vaults. Returns whether the snapshots differ"""
+    config = load_config()
+    chain = build_chain(config, latency=latency).start()
+    point_to(chain)
+    helper.Blockchain.reset()
+    Multicall.BATCH_SIZE = batch_size
+
+    durations, dfs = {}, {}
+    for name, query_class in (("serial", query.Query), ("async", async_query.AsyncQuery)):
+        start = time.perf_counter()
+        dfs[name] = query_class(config).compile() if name == "serial" else query_class(config, concurrency).compile()
+        durations[name] = time.perf_counter() - start
+    chain.stop()
+    Multicall.BATCH_SIZE = 200
+
+    print("bench concurrency: {} vaults with {}s latency, serial {:.3f}s, async {:.3f}s".format(
+        len(dfs["async"]), latency, durations["serial"], durations["async"]))
+    columns = [column for column in dfs["serial"].columns if column != "timestamp"]
+    return check("concurrency", [] if dfs["serial"][columns].equals(dfs["async"][columns]) else [
+        "async snapshot differs from the serial one"])
+
+
+def bench_incremental(blocks=25):
+    """polls the fake chain every `blocks` blocks with the incremental mode, once without any events and once after
+    a deposit into one vault and a swap in one pool, counting requests and the calls sent through multicall.
+    Returns whether the quiet run read any vault or the events run none"""
+    config = load_config()
+    chain = build_chain(config).start()
+    point_to(chain)
+    state_path = os.path.join(tempfile.mkdtemp(), 'state.json')
+    incremental.IncrementalQuery(config, state_path=state_path).compile()
+    vault = next(iter(next(iter(config['query'].values())).values()))
+    pool = config['uni_pools'][list(config['query'])[-1]]
+
+    runs = {}
+    for name in ("quiet", "events"):
+        chain.block_number += blocks
+        if name == "events":
+            chain.emit(vault, "Deposit(address,uint256)")
+            chain.emit(pool, incremental.IncrementalQuery.POOL_EVENTS[0])
+        chain.reset()
+        TELEMETRY.reset()
+        incremental.IncrementalQuery(config, state_path=state_path).compile()
+        runs[name] = (dict(Counter(chain.requests)), TELEMETRY.summary()["counters"])
+    chain.stop()
+
+    calls = {}
+    for name, (requests_by_method, counters) in runs.items():
+        calls[name] = sum(counter["value"] for counter in counters if counter["name"] == "multicall_calls")
+        print("bench incremental: {} run over {} blocks, {} requests {}, {} calls through multicall".format(
+            name, blocks, sum(requests_by_method.values()), requests_by_method, calls[name]))
+    failures = ["{} calls through multicall in the quiet run".format(calls["quiet"])] if calls["quiet"] else []
+    if not calls["events"]:
+        failures.append("no calls through multicall in the events run")
+    return check("incremental", failures)
+
+
+def bench_replay(latency=0.01, error_rate=0.3, error_methods=("eth_blockNumber", "eth_call")):
+    """records a compile run against the fake chain into a fixture, then replays it without the chain,
+    with latency and injected errors of the RPC methods, which are retried, and checks that the snapshot is the same.
+    Returns whether it differs"""
+    config = load_config()
+    chain = build_chain(config).start()
+    fixture = replay.Fixture(os.path.join(tempfile.mkdtemp(), 'fixture.json'))
+    recorder = replay.ReplayServer(fixture, upstreams={
+        "rpc": [chain.url], "etherscan": chain.url + "/api", "coingecko": chain.url + "/coingecko/"}).start()
+    recorder.install()
+    recorded = query.Query(config).compile()
+    recorder.stop()
+    chain.stop()
+    fixture.save()
+
+    server = replay.ReplayServer(replay.Fixture(fixture.path), latency=latency, error_rate=error_rate,
+                                 error_methods=error_methods).start()
+    server.install()
+    start = time.perf_counter()
+    replayed = query.Query(config).compile()
+    duration = time.perf_counter() - start
+    server.stop()
+
+    columns = [column for column in recorded.columns if column != "timestamp"]
+    same = recorded[columns].equals(replayed[columns])
+    print("bench replay: {} recorded interactions, replayed with {}s latency and {:.0%} injected errors "
+          "({} failed requests) in {:.3f}s, {} not recorded, snapshot {}".format(
+              sum(len(responses) for responses in fixture.interactions.values()), latency, error_rate,
+              server.errors, duration, len(server.fixture.misses), "identical" if same else "DIFFERENT"))
+    return check("replay", [] if same else ["replayed snapshot differs from the recorded one"])
+
+
+def bench_adapters():
+    """replays the recorded adapters fixture and compares the snapshot with the one of the per-manager vault
+    methods, every column they wrote but the timestamp. Floats may only differ by the rounding the exact decimal
+    conversion removed. Returns whether it failed"""
+    config = load_config()
+    server = replay.ReplayServer(replay.Fixture(ADAPTERS_FIXTURE_PATH)).start()
+    server.install()
+    df = query.Query(config).compile()
+    server.stop()
+    expected = pd.read_csv(ADAPTERS_EXPECTED_PATH)
+
+    failures = ["{} requests not recorded".format(len(server.fixture.misses))] if server.fixture.misses else []
+    if len(df) != len(expected):
+        failures.append("{} rows instead of {}".format(len(df), len(expected)))
+    else:
+        for column in expected.columns.drop("timestamp"):
+            actual, wanted = df[column].to_numpy(), expected[column].to_numpy()
+            if wanted.dtype.kind == 'f':
+                same = np.isclose(actual.astype(float), wanted, rtol=1e-12, atol=0)
+            else:
+                same = actual.astype(wanted.dtype) == wanted
+            for index in np.flatnonzero(~same):
+                failures.append("{} of {} {} is {}, expected {}".format(
+                    column, expected["poolId"][index], expected["manager"][index], actual[index], wanted[index]))
+    print("bench adapters: {} rows of {} columns compared with the per-manager methods, {} differences".format(
+        len(expected), len(expected.columns) - 1, len(failures)))
+    return check("adapters", failures)
+
+
+def bench_chains(vaults=50, latency=0.2, mainnet_latency=0.05, timeout=0.6):
+    """collects the pools of query_config.json on a faster fake mainnet together with `vaults` synthetic vaults on
+    a fake polygon node answering after `latency` seconds, one chain after the other and in parallel, after a
+    first run warmed the caches. Then once more with a `timeout` the slow chain exceeds, whose vaults become
+    error rows while mainnet is unaffected. Returns whether a row failed other than the timed out ones"""
+    config = load_config()
+    l2_config = synthetic_config(vaults)
+    config['query'].update(l2_config['query'])
+    config['uni_pools'].update(l2_config['uni_pools'])
+    config['chains'] = {str_pool: "polygon" for str_pool in l2_config['query']}
+    mainnet = build_chain(load_config(), latency=mainnet_latency).start()
+    l2 = build_chain(l2_config, latency=latency).start()
+    point_to(mainnet)
+    route(l2.url, chain="polygon")
+    helper.ABI_STORE = helper.AbiStore(cache_dir=tempfile.mkdtemp())
+    helper.Blockchain.reset()
+    query.MultiChainQuery(config).compile()
+
+    durations = {}
+    start = time.perf_counter()
+    for chain in query.Query.chains(config):
+        query.Query(config, chain=chain).compile()
+    durations["sequential"] = time.perf_counter() - start
+    start = time.perf_counter()
+    df = query.MultiChainQuery(config).compile()
+    durations["parallel"] = time.perf_counter() - start
+    start = time.perf_counter()
+    multi_chain_query = query.MultiChainQuery(config, timeout=timeout)
+    timed_out = multi_chain_query.compile()
+    durations["timeout"] = time.perf_counter() - start
+    # the run of the timed out chain goes on in the background, later benches would receive its requests
+    wait(multi_chain_query.running.values())
+    mainnet.stop()
+    l2.stop()
+
+    status = timed_out.groupby(["chain", "status"], observed=True).size().to_dict()
+    print("bench chains: {} rows {}, sequential {:.3f}s, parallel {:.3f}s, with a {}s timeout {:.3f}s and rows {}"
+          .format(len(df), df["chain"].value_counts().to_dict(), durations["sequential"], durations["parallel"],
+                  timeout, durations["timeout"], status))
+    failures = ["{} error rows without a timeout".format(int((df["status"] != "ok").sum()))] \
+        if (df["status"] != "ok").any() else []
+    mainnet_rows = timed_out[timed_out["chain"] == helper.DEFAULT_CHAIN]
+    if (mainnet_rows["status"] != "ok").any():
+        failures.append("{} mainnet error rows with the timeout".format(int((mainnet_rows["status"] != "ok").sum())))
+    return check("chains", failures)
+
+
+def bench_scale(sizes=(10, 100, 1000), baseline_path=BASELINE_PATH):
+    """end-to-end compile runs on configs of the given numbers of vaults. A cold run starts from empty ABI, pool
+    and token caches, the warm run after it is what a scheduled deployment runs every tick, the peak memory of
+    a second warm run is measured with tracemalloc. Results are compared against the baseline at baseline_path,
+    which they replace unless they regressed. Time and memory depend on the machine and its load, their
+    regressions are only reported. Returns whether the request counts, which are deterministic, regressed"""
+    try:
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+    results = {}
+    for size in sizes:
+        config = synthetic_config(size)
+        chain = build_chain(config).start()
+        point_to(chain)
+        helper.ABI_STORE = helper.AbiStore(cache_dir=tempfile.mkdtemp(), use_bundle=False)
+        helper.Blockchain.reset()
+
+        start = time.perf_counter()
+        query.Query(config).compile()
+        cold = time.perf_counter() - start
+        cold_requests = chain.count() - chain.count("batch")
+
+        chain.reset()
+        start = time.perf_counter()
+        df = query.Query(config).compile()
+        warm = time.perf_counter() - start
+        requests_by_method = Counter(chain.requests)
+
+        tracemalloc.start()
+        query.Query(config).compile()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        chain.stop()
+
+        results[str(size)] = {"cold_seconds": cold, "warm_seconds": warm, "cold_requests": cold_requests,
+                              "warm_requests": sum(requests_by_method.values()), "peak_mb": peak / 2 ** 20}
+        print("bench scale: {} vaults ({} rows), cold run {:.3f}s with {} requests, warm run {:.3f}s with {} "
+              "requests ({}), peak memory {:.1f} MB".format(
+                  size, len(df), cold, cold_requests, warm, sum(requests_by_method.values()),
+                  dict(requests_by_method), peak / 2 ** 20))
+
+    regressions, slower = [], []
+    for size, result in results.items():
+        for metric, value in result.items():
+            previous = baseline.get(size, {}).get(metric)
+            if previous is None:
+                continue
+            # request counts are deterministic and may not grow at all
+            limit = previous if metric.endswith("requests") else previous * TOLERANCE
+            if value > limit:
+                (regressions if metric.endswith("requests") else slower).append(
+                    "regression at {} vaults, {} {:.3f} against a baseline of {:.3f}".format(
+                        size, metric, value, previous))
+    for regression in slower:
+        print("bench scale: {} (not counted as a failure)".format(regression))
+    if not regressions and not slower:
+        with open(baseline_path, 'w') as f:
+            json.dump(dict(baseline, **results), f, indent=2)
+    return check("scale", regressions)
+
+
+if __name__ == '__main__':
+    # every bench runs, benchmark.py exits non-zero if any of them failed
+    failed = [bench.__name__ for bench in (bench_multicall, bench_pool_cache, bench_precision, bench_schema,
+                                           bench_connections, bench_concurrency, bench_incremental, bench_replay,
+                                           bench_adapters, bench_chains, bench_scale) if bench()]
+    if failed:
+        print("log: failed benches: {}".format(", ".join(failed)))
+    sys.exit(1 if failed else 0)
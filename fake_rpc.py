@@ -0,0 +1,267 @@
+import os
+import json
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+
+import helper
+import oracle
+import pools
+import tokens
+from multicall import Multicall
+
+
+def label(path, query):
+    """name under which a GET request is recorded, the CoinGecko endpoint or the etherscan action"""
+    for endpoint in ("simple/price", "market_chart/range"):
+        if path.endswith(endpoint):
+            return endpoint
+    if "/contract/" in path:
+        return "coins/contract"
+    return query.get("action", [path])[0]
+
+
+def route(url, api_key=None, chain=helper.DEFAULT_CHAIN):
+    """routes RPC and explorer traffic of the chain to a local server at url, coingecko is shared by all chains
+    and follows the default chain"""
+    helper.Blockchain.RPC_DICT[chain] = url
+    helper.EvmAPI.API_DICT[chain] = [url + "/api", api_key]
+    if chain == helper.DEFAULT_CHAIN:
+        oracle.CoinGeckoSource.API_URL = url + "/coingecko/"
+    return
+
+
+def point_to(server):
+    """routes all traffic to the local server, prices are not cached between runs and pool and token metadata
+    are read from empty caches"""
+    route(server.url)
+    oracle.PriceOracle.CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'prices.json')
+    oracle.PriceOracle.TTL = 0
+    pools.PoolRegistry.CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'pools.json')
+    tokens.TokenRegistry.CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'tokens.json')
+    return
+
+
+class LocalServer:
+    """Local HTTP server standing in for the JSON-RPC node (POST /), etherscan (GET /api) and CoinGecko
+    (GET /coingecko/...) at once, see benchmark.point_to. Every request is recorded, so that benchmarks can count
+    round trips. Each response is delayed by `latency` seconds, a share `error_rate` of the requests (of the
+    methods in error_methods, all by default) fails instead, with 503 for JSON-RPC and 429 for etherscan and
+    CoinGecko, so that retries and failover can be exercised"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_methods=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_methods = error_methods
+        self.random = random.Random(seed)
+        self.requests = []
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def handle_rpc(self, payload):
+        raise NotImplementedError
+
+    def handle_get(self, path, query):
+        raise NotImplementedError
+
+    @staticmethod
+    def answer(result):
+        """handlers return a JSON body, or a (body, status) pair for other statuses than 200"""
+        return result if isinstance(result, tuple) else (result, 200)
+
+    def count(self, method=None):
+        with self.lock:
+            return len([r for r in self.requests if method is None or r == method])
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+            self.errors = 0
+
+    def record(self, method):
+        with self.lock:
+            self.requests.append(method)
+
+    def inject_error(self, method):
+        if self.error_methods is not None and method not in self.error_methods:
+            return False
+        with self.lock:
+            failed = self.error_rate > 0 and self.random.random() < self.error_rate
+            self.errors += failed
+        return failed
+
+    # server lifecycle
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def start(self):
+        chain = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive, so that connection reuse of the clients can be measured
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, with Nagle's algorithm every response would wait for
+            # the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                payload = json.loads(self.rfile.read(length))
+                if chain.inject_error("batch" if isinstance(payload, list) else payload["method"]):
+                    return self.respond({"error": "injected"}, status=503)
+                self.respond(*chain.answer(chain.handle_rpc(payload)))
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if chain.inject_error(label(parsed.path, parse_qs(parsed.query))):
+                    return self.respond({"error": "injected"}, status=429)
+                self.respond(*chain.answer(chain.handle_get(parsed.path, parse_qs(parsed.query))))
+
+            def respond(self, body, status=200):
+                if chain.latency:
+                    time.sleep(chain.latency)
+                encoded = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def log_message(self, format, *args):
+                return
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeChain(LocalServer):
+    """Local stand-in for an Ethereum JSON-RPC node, the etherscan ABI and the CoinGecko price and
+    contract lookup endpoints. It answers eth_call (directly or through Multicall3's aggregate3) from registered
+    return values"""
+
+    def __init__(self, block_number=14000000, latency=0.0, price=1.0, error_rate=0.0, error_methods=None, seed=0):
+        super().__init__(latency=latency, error_rate=error_rate, error_methods=error_methods, seed=seed)
+        self.block_number = block_number
+        self.price = price
+        self.functions = {}
+        self.abis = {}
+        self.coins = {}
+        self.logs = []
+
+    def register(self, address, fn_name, output_types, values, input_types=(), args=()):
+        """registers the return value of a function for the given arguments (none by default)
+        and adds the function to the contract's ABI"""
+        address = address.lower()
+        selector = Web3.keccak(text="{}({})".format(fn_name, ",".join(input_types)))[:4]
+        call_data = selector + encode_abi(list(input_types), list(args))
+        self.functions[(address, call_data)] = encode_abi(output_types, values)
+        abi = self.abis.setdefault(address, [])
+        if fn_name in [item["name"] for item in abi]:
+            return
+        abi.append({
+            "type": "function",
+            "name": fn_name,
+            "inputs": [{"name": "", "type": input_type} for input_type in input_types],
+            "outputs": [{"name": "", "type": output_type} for output_type in output_types],
+            "stateMutability": "view",
+        })
+
+    def emit(self, address, event, block_number=None):
+        """adds a log of the given event signature, e.g. "Swap(address,...)", at block_number (the latest block)"""
+        self.logs.append({"address": Web3.toChecksumAddress(address),
+                          "topics": [Web3.toHex(Web3.keccak(text=event))],
+                          "blockNumber": self.block_number if block_number is None else block_number})
+
+    # JSON-RPC handling
+    def handle_rpc(self, payload):
+        if isinstance(payload, list):
+            self.record("batch")
+            return [self.handle_rpc_call(item) for item in payload]
+        return self.handle_rpc_call(payload)
+
+    def handle_rpc_call(self, payload):
+        method = payload["method"]
+        self.record(method)
+        response = {"jsonrpc": "2.0", "id": payload.get("id")}
+        if method == "eth_blockNumber":
+            response["result"] = hex(self.block_number)
+        elif method == "eth_chainId":
+            response["result"] = "0x1"
+        elif method == "net_version":
+            response["result"] = "1"
+        elif method == "eth_call":
+            call = payload["params"][0]
+            try:
+                data = self.call(call["to"], Web3.toBytes(hexstr=call["data"]))
+                response["result"] = Web3.toHex(data)
+            except KeyError:
+                response["error"] = {"code": -32000, "message": "execution reverted"}
+        elif method == "eth_getLogs":
+            query = payload["params"][0]
+            addresses = set(address.lower() for address in query.get("address", []))
+            start, end = int(query["fromBlock"], 16), int(query["toBlock"], 16)
+            response["result"] = [{
+                "address": log["address"],
+                "topics": log["topics"],
+                "data": "0x",
+                "blockNumber": hex(log["blockNumber"]),
+                "blockHash": "0x" + "00" * 32,
+                "transactionHash": "0x" + "00" * 32,
+                "transactionIndex": "0x0",
+                "logIndex": hex(index),
+                "removed": False,
+            } for index, log in enumerate(self.logs)
+                if log["address"].lower() in addresses and start <= log["blockNumber"] <= end]
+        else:
+            response["error"] = {"code": -32601, "message": "method {} not supported".format(method)}
+        return response
+
+    def call(self, address, data):
+        address = address.lower()
+        if address == Multicall.ADDRESS.lower() and data[:4] == Multicall.AGGREGATE3_SELECTOR:
+            (calls,) = decode_abi(["(address,bool,bytes)[]"], data[4:])
+            results = []
+            for target, allow_failure, call_data in calls:
+                try:
+                    results.append((True, self.call(target, call_data)))
+                except KeyError:
+                    if not allow_failure:
+                        raise
+                    results.append((False, b""))
+            return encode_abi(["(bool,bytes)[]"], [results])
+        return self.functions[(address, bytes(data))]
+
+    # etherscan and coingecko handling
+    def handle_get(self, path, query):
+        self.record(label(path, query))
+        if path.endswith("simple/price"):
+            return {cg_id: {"usd": self.price} for cg_id in query["ids"][0].split(",")}
+        if "/contract/" in path:
+            address = path.rsplit("/", 1)[1].lower()
+            return {"id": self.coins[address]} if address in self.coins else {"error": "coin not found"}
+        if path.endswith("market_chart/range"):
+            start, end = int(float(query["from"][0])), int(float(query["to"][0]))
+            return {"prices": [[timestamp * 1000, self.price] for timestamp in range(start, end + 1, 3600)]}
+        if query.get("action") == ["getblocknobytime"]:
+            # blocks are 12 seconds apart and the latest block was mined now
+            return {"status": "1", "message": "OK",
+                    "result": str(self.block_number - (int(time.time()) - int(query["timestamp"][0])) // 12)}
+        address = query.get("address", [""])[0].lower()
+        if query.get("action") == ["getabi"] and address in self.abis:
+            return {"status": "1", "message": "OK", "result": json.dumps(self.abis[address])}
+        return {"status": "0", "message": "NOTOK", "result": "unknown request"}
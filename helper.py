@@ -1,26 +1,45 @@
 import requests
 import os
 import json
+import time
+import hashlib
+import random
+import tempfile
+import threading
 import gspread
 import pandas as pd
 
-from web3 import Web3
+from urllib.parse import urlparse
+from cachetools import LRUCache
+from web3 import Web3, HTTPProvider
+from web3.middleware import simple_cache_middleware
 
-# manage API_KEY with heroku setup vs. local testing
+from telemetry import TELEMETRY
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# chain of pools the config does not assign to another one
+DEFAULT_CHAIN = "ethereum"
+
+# manage API_KEY with heroku setup vs. local testing, ABIs are cached so etherscan may also run without a key.
+# The explorers of the other chains take their own keys, API_KEY_<CHAIN> on heroku or API_KEYS in config.json
+API_KEY = None
+API_KEYS = {}
 ON_HEROKU = os.environ.get("ON_HEROKU")
 if ON_HEROKU:
     print("log: system is aware its on heroku")
     API_KEY = os.environ.get('API_KEY')
+    API_KEYS = {chain: os.environ.get('API_KEY_' + chain.upper()) for chain in ("polygon", "arbitrum", "optimism")}
     string_gs_service = os.environ.get('GS_SERVICE')
     GS_SERVICE = json.loads(string_gs_service)
 else:
     print("log: system is aware it is not on heroku")
-    ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
     CONFIG_PATH = os.path.join(ROOT_DIR, 'config.json')
     try:
         with open(CONFIG_PATH, 'r') as f:
             config = json.load(f)
             API_KEY = config['API_KEY']
+            API_KEYS = config.get('API_KEYS', {})
     except FileNotFoundError:
         print("log: config file not found")
 
@@ -37,8 +56,14 @@ class EvmAPI:
     getting the contract ABI and the native token balance"""
 
     API_DICT = {
-        "ethereum": ["https://api.etherscan.io/api", API_KEY]
+        "ethereum": ["https://api.etherscan.io/api", API_KEY],
+        "polygon": ["https://api.polygonscan.com/api", API_KEYS.get("polygon")],
+        "arbitrum": ["https://api.arbiscan.io/api", API_KEYS.get("arbitrum")],
+        "optimism": ["https://api-optimistic.etherscan.io/api", API_KEYS.get("optimism")],
     }
+    MAX_RETRIES = 5
+    BACKOFF = 0.5
+    SESSION = requests.Session()
 
     def __init__(self, blockchain):
         self.blockchain = blockchain.lower()
@@ -86,34 +111,245 @@ class EvmAPI:
                         "&address=" + contract_address
         return self.execute(module_string)
 
+    def get_block_by_time(self, timestamp):
+        module_string = "?module=block" \
+                        "&action=getblocknobytime" \
+                        "&timestamp=" + str(timestamp) + \
+                        "&closest=before"
+        return int(self.execute(module_string))
+
     def gas_oracle(self):
         module_string = "?module=gastracker" \
                         "&action=gasoracle"
         return self.execute(module_string)
 
     def execute(self, module_string):
+        """queries etherscan and backs off exponentially while its rate limit (5 req/s) is hit"""
         if self.api_key is None:
             module_string_adapted = module_string
         else:
             module_string_adapted = module_string + "&apikey=" + self.api_key
-        result = requests.get(self.url_stem + module_string_adapted).json()['result']
-        return result
+        action = module_string.split("&action=")[1].split("&")[0]
+        for attempt in range(self.MAX_RETRIES):
+            with TELEMETRY.span("etherscan", action=action):
+                response = self.SESSION.get(self.url_stem + module_string_adapted, timeout=Blockchain.TIMEOUT)
+            TELEMETRY.count("etherscan_requests", action=action)
+            TELEMETRY.count("etherscan_bytes_received", len(response.content), action=action)
+            if response.status_code == 429:
+                wait = float(response.headers.get("Retry-After", self.BACKOFF * 2 ** attempt))
+            else:
+                body = response.json()
+                if not (body.get('status') == "0" and "rate limit" in str(body.get('result')).lower()):
+                    return body['result']
+                wait = self.BACKOFF * 2 ** attempt
+            print("log: etherscan rate limit reached, retrying in {}s".format(wait))
+            TELEMETRY.count("etherscan_retries", action=action)
+            time.sleep(wait)
+        raise RuntimeError("etherscan rate limit still reached after {} retries".format(self.MAX_RETRIES))
+
+
+class AbiStore:
+    """Persistent ABI store, so that etherscan is only asked for ABIs that were never seen before.
+    ABIs are saved content-addressed on disk (objects/<sha256>.json), an index maps chain and ABI address
+    to the content hash, and an in-process LRU cache sits in front. ABIs of the known managers are bundled
+    in abis.json and used before etherscan is queried"""
+
+    CACHE_DIR = os.path.join(ROOT_DIR, '.abi_cache')
+    BUNDLE_PATH = os.path.join(ROOT_DIR, 'abis.json')
+    LRU_SIZE = 256
+
+    def __init__(self, cache_dir=CACHE_DIR, bundle_path=BUNDLE_PATH, use_bundle=True):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lru = LRUCache(maxsize=self.LRU_SIZE)
+        # guards the LRU cache, the index and the files, which are not thread-safe
+        self.lock = threading.RLock()
+        # {key: lock} of the ABIs being fetched from the explorer
+        self.fetching = {}
+        self.index = None
+        self.bundle = {"abis": {}, "addresses": {}}
+        if use_bundle:
+            try:
+                with open(bundle_path, 'r') as f:
+                    self.bundle = json.load(f)
+            except FileNotFoundError:
+                print("log: abi bundle not found")
+
+    def get(self, blockchain, abi_address):
+        """ABI of the given address. The store is shared by the threads of all chains: its lock only guards the
+        LRU cache, index and files, explorer fetches run outside of it, one at a time per ABI"""
+        key = "{}:{}".format(blockchain.lower(), abi_address.lower())
+        with self.lock:
+            abi = self.lookup(key, abi_address)
+            if abi is not None:
+                return abi
+            fetch_lock = self.fetching.setdefault(key, threading.Lock())
+        with fetch_lock:
+            with self.lock:
+                # fetched by another thread meanwhile
+                abi = self.lookup(key, abi_address)
+            if abi is not None:
+                return abi
+            try:
+                print("log: fetching abi of {} from explorer".format(abi_address))
+                abi = self.parse(blockchain, abi_address, EvmAPI(blockchain).get_abi(abi_address))
+                self.save(key, abi)
+                TELEMETRY.count("abi_lookups", source="explorer")
+                with self.lock:
+                    self.lru[key] = abi
+            finally:
+                with self.lock:
+                    self.fetching.pop(key, None)
+        return abi
+
+    def lookup(self, key, abi_address):
+        """ABI from the LRU cache, disk or bundle, None if it has to be fetched. Called with the lock held"""
+        if key in self.lru:
+            TELEMETRY.count("abi_lookups", source="memory")
+            return self.lru[key]
+        abi = self.load(key)
+        source = "disk"
+        if abi is None:
+            bundle_name = self.bundle["addresses"].get(abi_address.lower())
+            if bundle_name is None:
+                return None
+            abi = self.bundle["abis"][bundle_name]
+            source = "bundle"
+        TELEMETRY.count("abi_lookups", source=source)
+        self.lru[key] = abi
+        return abi
+
+    @staticmethod
+    def parse(blockchain, abi_address, result):
+        """the ABI in the result of an explorer getabi request, which holds the error message instead
+        when the explorer has none (status "0"), e.g. of unverified contracts"""
+        try:
+            abi = json.loads(result)
+        except (TypeError, ValueError):
+            abi = None
+        if not isinstance(abi, list):
+            raise LookupError("no abi of {} on the {} explorer: {}".format(abi_address, blockchain, result))
+        return abi
+
+    def load(self, key):
+        if self.index is None:
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.index = json.load(f)
+            except FileNotFoundError:
+                self.index = {}
+        digest = self.index.get(key)
+        if digest is None:
+            return None
+        with open(os.path.join(self.cache_dir, 'objects', digest + '.json'), 'r') as f:
+            return json.load(f)
+
+    def save(self, key, abi):
+        content = json.dumps(abi, sort_keys=True)
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        with self.lock:
+            os.makedirs(os.path.join(self.cache_dir, 'objects'), exist_ok=True)
+            object_path = os.path.join(self.cache_dir, 'objects', digest + '.json')
+            if not os.path.exists(object_path):
+                write_atomic(object_path, content)
+            self.index[key] = digest
+            write_atomic(self.index_path, json.dumps(self.index, indent=2))
+        return
+
+
+def chain_path(path, blockchain):
+    """path of a per-chain cache file, e.g. .pool_cache_polygon.json, the default chain keeps the plain path"""
+    if blockchain.lower() == DEFAULT_CHAIN:
+        return path
+    root, extension = os.path.splitext(path)
+    return "{}_{}{}".format(root, blockchain.lower(), extension)
+
+
+def write_atomic(path, content):
+    """writes to a temporary file first, so that an interrupted run never leaves half a cache file behind.
+    Every write gets its own temporary file, writers of the same path in other threads or processes never
+    write into each other's"""
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                     suffix='.tmp', delete=False) as f:
+        f.write(content)
+    try:
+        # temporary files are private, the written file keeps the mode of the one it replaces
+        os.chmod(f.name, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+    return
+
+
+ABI_STORE = AbiStore()
 
 
 class Blockchain:
-    """Primarily used to make code less lengthy and ease interacting with contracts on chain"""
+    """Primarily used to make code less lengthy and ease interacting with contracts on chain
+    Web3 providers are kept per chain in a registry and share one keep-alive requests.Session,
+    contract instances are memoized by (chain, address, ABI address).
+    Each chain lists its RPC endpoints in order of preference, later ones are backups"""
 
     RPC_DICT = {
-        "ethereum": "https://eth-mainnet.gateway.pokt.network/v1/5f3453978e354ab992c4da79",
+        "ethereum": [
+            "https://eth-mainnet.gateway.pokt.network/v1/5f3453978e354ab992c4da79",
+            "https://rpc.ankr.com/eth",
+            "https://cloudflare-eth.com",
+        ],
+        "polygon": [
+            "https://polygon-rpc.com",
+            "https://rpc.ankr.com/polygon",
+        ],
+        "arbitrum": [
+            "https://arb1.arbitrum.io/rpc",
+            "https://rpc.ankr.com/arbitrum",
+        ],
+        "optimism": [
+            "https://mainnet.optimism.io",
+            "https://rpc.ankr.com/optimism",
+        ],
     }
+    POOL_SIZE = 10
+    TIMEOUT = 30
 
-    def __init__(self, blockchain):
+    PROVIDERS = {}
+    CONTRACTS = {}
+    LOCK = threading.Lock()
+
+    def __init__(self, blockchain, pool_size=None, timeout=None):
         self.blockchain = blockchain.lower()
+        self.pool_size = pool_size or self.POOL_SIZE
+        self.timeout = timeout or self.TIMEOUT
+
+    @classmethod
+    def reset(cls):
+        """drops all cached providers and contract instances, e.g. after RPC_DICT changed"""
+        with cls.LOCK:
+            cls.PROVIDERS.clear()
+            cls.CONTRACTS.clear()
+        return
+
+    def get_endpoints(self):
+        # get correct RPC addresses
+        endpoints = self.RPC_DICT[self.blockchain]
+        return [endpoints] if isinstance(endpoints, str) else list(endpoints)
+
+    def provider_key(self):
+        """providers are shared by all instances of the same chain, endpoints, pool size and timeout"""
+        return self.blockchain, tuple(self.get_endpoints()), self.pool_size, self.timeout
 
     def get_w3(self):
-        # get correct RPC address
-        rpc_url = self.RPC_DICT[self.blockchain]
-        w3 = Web3(Web3.HTTPProvider(rpc_url))
+        endpoints = self.get_endpoints()
+        key = self.provider_key()
+        with self.LOCK:
+            w3 = self.PROVIDERS.get(key)
+            if w3 is None:
+                session = create_session(self.pool_size)
+                w3 = Web3(FailoverHTTPProvider(endpoints, session, request_kwargs={"timeout": self.timeout}))
+                # web3 validates every eth_call against eth_chainId, which never changes for an endpoint
+                w3.middleware_onion.add(simple_cache_middleware)
+                self.PROVIDERS[key] = w3
         return w3
 
     def create_contract(self, contract_address, abi_address=None):
@@ -125,42 +361,166 @@ class Blockchain:
         abi_address = Web3.toChecksumAddress(abi_address)
         contract_address = Web3.toChecksumAddress(contract_address)
 
-        # get correct RPC address
-        rpc_url = self.RPC_DICT[self.blockchain]
-        w3 = Web3(Web3.HTTPProvider(rpc_url))
-
-        # get ABI
-        abi = EvmAPI(self.blockchain).get_abi(abi_address)
-
-        # create contract instance
-        contract_instance = w3.eth.contract(address=contract_address, abi=abi)
+        # contract instances are bound to the provider they were created with
+        key = self.provider_key() + (contract_address, abi_address)
+        contract_instance = self.CONTRACTS.get(key)
+        TELEMETRY.count("contract_lookups", result="miss" if contract_instance is None else "hit")
+        if contract_instance is None:
+            # get ABI and create contract instance
+            abi = ABI_STORE.get(self.blockchain, abi_address)
+            contract_instance = self.get_w3().eth.contract(address=contract_address, abi=abi)
+            self.CONTRACTS[key] = contract_instance
 
         return contract_instance
 
     def create_account(self, private_key):
-        # get correct RPC address
-        rpc_url = self.RPC_DICT[self.blockchain]
-        w3 = Web3(Web3.HTTPProvider(rpc_url))
-
         # create account
-        account = w3.eth.account.from_key(private_key)
+        account = self.get_w3().eth.account.from_key(private_key)
         return account
 
 
+class FailoverHTTPProvider(HTTPProvider):
+    """HTTPProvider posting through the given requests.Session, instead of web3's session cache
+    which holds one session per thread and ignores a session passed in for an already cached endpoint.
+    Failed requests (timeouts, connection and HTTP errors) are retried with jittered exponential backoff
+    on the first endpoint whose circuit breaker is closed, so that a dead endpoint fails over to the backups"""
+
+    MAX_RETRIES = 4
+
+    def __init__(self, endpoints, session, request_kwargs=None):
+        super().__init__(endpoints[0], request_kwargs=request_kwargs)
+        self.endpoints = endpoints
+        self.session = session
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        error = None
+        for attempt in range(self.MAX_RETRIES):
+            endpoint = CircuitBreaker.pick(self.endpoints)
+            breaker = CircuitBreaker.get(endpoint)
+            host = urlparse(endpoint).netloc
+            TELEMETRY.count("rpc_requests", endpoint=host, method=method)
+            TELEMETRY.count("rpc_bytes_sent", len(request_data), endpoint=host, method=method)
+            try:
+                with TELEMETRY.span("rpc", endpoint=host, method=method):
+                    response = self.session.post(endpoint, data=request_data, **self.get_request_kwargs())
+                    response.raise_for_status()
+            except requests.RequestException as e:
+                breaker.failure()
+                error = e
+                wait = backoff(attempt)
+                print("log: {} to {} failed, retrying in {:.1f}s ({})".format(method, host, wait, type(e).__name__))
+                TELEMETRY.count("rpc_retries", endpoint=host, method=method)
+                time.sleep(wait)
+                continue
+            breaker.success()
+            TELEMETRY.count("rpc_bytes_received", len(response.content), endpoint=host, method=method)
+            return self.decode_rpc_response(response.content)
+        raise error
+
+
+class CircuitBreaker:
+    """Tracks failures per endpoint. After FAILURES consecutive failures the breaker opens and the endpoint
+    is skipped for COOLDOWN seconds, after which one trial request may close it again"""
+
+    FAILURES = 3
+    COOLDOWN = 30
+    BREAKERS = {}
+    LOCK = threading.Lock()
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+
+    @classmethod
+    def get(cls, endpoint):
+        with cls.LOCK:
+            return cls.BREAKERS.setdefault(endpoint, cls())
+
+    @classmethod
+    def pick(cls, endpoints):
+        """first endpoint whose breaker allows a request, or the one that was opened the longest time ago"""
+        breakers = [cls.get(endpoint) for endpoint in endpoints]
+        for endpoint, breaker in zip(endpoints, breakers):
+            if breaker.allow():
+                return endpoint
+        return min(zip(endpoints, breakers), key=lambda item: item[1].opened_at)[0]
+
+    def allow(self):
+        return self.opened_at is None or time.time() - self.opened_at >= self.COOLDOWN
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        return
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.FAILURES:
+            self.opened_at = time.time()
+        return
+
+
+def backoff(attempt, base=0.5):
+    """exponential backoff with +-50% jitter, so that retrying clients do not hit an endpoint in lockstep"""
+    return base * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
+def create_session(pool_size):
+    """returns a requests.Session whose connection pool keeps up to pool_size connections alive per host"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 class Sheets():
     """This class will enable saving and retrieving of data from google spreadsheets
-    It always retrieves and writes data from and to the given spreadsheet"""
+    It always retrieves and writes data from and to the given spreadsheet, the full sheet is only downloaded
+    when get_df is called, so that appending rows costs the same no matter how long the history is"""
 
     def __init__(self, sheet_name):
         self.sheet_name = sheet_name
         gc = gspread.service_account_from_dict(info=GS_SERVICE)
         self.sheet = gc.open(self.sheet_name).sheet1
-        self.df = pd.DataFrame(self.sheet.get_all_records())
+        self.df = None
 
     def get_df(self):
+        if self.df is None:
+            with TELEMETRY.span("sheets", method="get_all_records"):
+                self.df = pd.DataFrame(self.sheet.get_all_records())
         return self.df
 
+    def get_header(self):
+        with TELEMETRY.span("sheets", method="row_values"):
+            return self.sheet.row_values(1)
+
+    def get_columns(self, columns):
+        """downloads only the given columns, returns a dataframe without the header row"""
+        header = self.get_header()
+        with TELEMETRY.span("sheets", method="col_values"):
+            return pd.DataFrame({column: self.sheet.col_values(header.index(column) + 1)[1:] for column in columns})
+
     def write_df(self, df):
         self.sheet.update([df.columns.values.tolist()] + df.values.tolist())
         print("log: files successfully written to google sheet")
         return
+
+    def append_df(self, df):
+        """appends the rows of df below the existing ones, in the column order of the sheet's header"""
+        header = self.get_header()
+        new_columns = [column for column in df.columns if column not in header]
+        if new_columns:
+            # columns which were added to the dataframe since the sheet was created extend its header
+            header = header + new_columns
+            if self.sheet.col_count < len(header):
+                self.sheet.add_cols(len(header) - self.sheet.col_count)
+            self.sheet.update('A1', [header])
+        rows = df.reindex(columns=header)
+        rows = rows.astype(object).where(rows.notna(), "")
+        with TELEMETRY.span("sheets", method="append_rows"):
+            self.sheet.append_rows(rows.values.tolist(), value_input_option="RAW")
+        TELEMETRY.count("sheets_rows_appended", len(rows))
+        print("log: {} rows appended to google sheet".format(len(df)))
+        return
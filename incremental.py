@@ -0,0 +1,293 @@
+import os
+import json
+import asyncio
+import threading
+
+import websockets
+from web3 import Web3
+
+import helper
+import query
+from pools import PoolRegistry
+from telemetry import TELEMETRY
+
+
+class IncrementalQuery(query.Query):
+    """Query which only re-reads the vaults that changed since they were last read. Before a run the logs of all
+    vaults and uni pools of the run since the oldest of their last read blocks are pulled with one eth_getLogs
+    request filtered by address. A vault is re-read when it emitted any event (deposits, withdrawals, rebalances)
+    or its pool emitted one of POOL_EVENTS after the vault's last read, every other vault carries its state and
+    positions forward and is only re-priced. The same holds for the state of the pools. With a websocket subscription
+    (subscribe) the logs are collected as they are emitted instead of being pulled.
+    The last read state and block of every vault and pool are kept in STATE_PATH. Runs whose range exceeds
+    MAX_BLOCKS, or whose logs are unavailable, read every vault"""
+
+    STATE_PATH = os.path.join(helper.ROOT_DIR, '.incremental_state.json')
+    # widest block range requested with eth_getLogs, many providers refuse larger ones
+    MAX_BLOCKS = 2000
+    # pool events changing the amounts held by the positions of its vaults or their uncollected fees,
+    # flash loans pay fees into the fee growth of the pool
+    POOL_EVENTS = [
+        "Swap(address,address,int256,int256,uint160,uint128,int24)",
+        "Mint(address,address,int24,int24,uint128,uint256,uint256)",
+        "Burn(address,int24,int24,uint128,uint256,uint256)",
+        "Collect(address,address,int24,int24,uint128,uint128)",
+        "Flash(address,address,uint256,uint256,uint256,uint256)",
+    ]
+    POOL_TOPICS = set(Web3.toHex(Web3.keccak(text=event)) for event in POOL_EVENTS)
+
+    def __init__(self, config, state_path=None, chain=helper.DEFAULT_CHAIN):
+        super().__init__(config, chain=chain)
+        self.state_path = state_path or helper.chain_path(self.STATE_PATH, self.chain)
+        try:
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {"vaults": {}, "pools": {}}
+        self.subscription = None
+        self.block = None
+        # {lowercase address: block of its latest relevant event} of the current run, None if all are read
+        self.latest = None
+
+    @staticmethod
+    def vault_key(str_pool, str_manager, str_contract):
+        return "{}/{}/{}".format(str_pool, str_manager, str_contract.lower())
+
+    def addresses(self, pools=None):
+        """lowercase addresses of the vaults and uni pools of the config"""
+        return sorted(set([str_contract.lower() for str_pool, str_manager, str_contract in self.vaults(pools)]
+                          + [address.lower() for address in self.pool_addresses(pools).values()]))
+
+    def compile(self, block_identifier="latest", timestamp=None, price_oracle=None, pools=None):
+        """pulls the logs up to the block of the run and compiles the dataframe from the vaults and pools which
+        changed and the carried state of the others"""
+        self.block = self.bc.get_w3().eth.block_number if block_identifier == "latest" else block_identifier
+        with TELEMETRY.span("phase", phase="logs"):
+            self.latest = self.get_latest_events(pools)
+        df = super().compile(self.block, timestamp, price_oracle, pools)
+        self.save(pools)
+        return df
+
+    def get_latest_events(self, pools=None):
+        """{lowercase address: block of its latest relevant event} after the oldest last read block
+        of the run's vaults and pools, None if their logs cannot be known"""
+        since = self.since(pools)
+        if since is None:
+            return None
+        start = since + 1
+        if start > self.block:
+            return {}
+        if self.block - start >= self.MAX_BLOCKS:
+            print("log: {} blocks since the last incremental run, reading all vaults".format(self.block - start + 1))
+            return None
+        if self.subscription is not None and self.subscription.covers(start):
+            logs = self.subscription.get_logs(start, self.block)
+        else:
+            try:
+                logs = [(log["address"], log["blockNumber"], log["topics"][0] if log["topics"] else None)
+                        for log in self.bc.get_w3().eth.get_logs({
+                            "fromBlock": start,
+                            "toBlock": self.block,
+                            "address": [Web3.toChecksumAddress(address) for address in self.addresses(pools)]})]
+            except Exception as e:
+                print("log: logs of blocks {} to {} unavailable, reading all vaults ({})".format(start, self.block, e))
+                return None
+
+        pool_addresses = set(address.lower() for address in self.config['uni_pools'].values())
+        latest = {}
+        for address, block, topic in logs:
+            address = address.lower()
+            topic = topic if topic is None or isinstance(topic, str) else Web3.toHex(topic)
+            if address in pool_addresses and (topic or "").lower() not in self.POOL_TOPICS:
+                continue
+            latest[address] = max(latest.get(address, 0), block)
+        TELEMETRY.count("incremental_logs", len(logs))
+        print("log: {} logs in blocks {} to {}, {} vaults and pools changed".format(
+            len(logs), start, self.block, len(latest)))
+        return latest
+
+    def since(self, pools=None):
+        """oldest last read block of the run's vaults and pools, None if none of them was read before"""
+        entries = [self.state["vaults"].get(self.vault_key(*vault)) for vault in self.vaults(pools)] + \
+                  [self.state["pools"].get(address.lower()) for address in self.pool_addresses(pools).values()]
+        blocks = [entry["block"] for entry in entries if entry is not None]
+        return min(blocks) if blocks else None
+
+    def unchanged(self, entry, *addresses):
+        """whether state last read at entry's block still holds, i.e. none of the addresses had an event since"""
+        return self.latest is not None and entry is not None and all(
+            self.latest.get(address.lower(), 0) <= entry["block"] for address in addresses)
+
+    def queue_pools(self, multicall, pools=None):
+        """queues the state of the changed pools, the state of the others is carried into the pool registry"""
+        addresses = set(address.lower() for address in self.pool_addresses(pools).values())
+        carried = {address: self.state["pools"][address]["state"] for address in addresses
+                   if self.unchanged(self.state["pools"].get(address), address)
+                   and set(PoolRegistry.STATE) <= set(self.state["pools"][address]["state"])}
+        self.pool_registry.put_state(self.block, carried)
+        return self.pool_registry.queue_state(multicall, addresses - set(carried))
+
+    def queue_vaults(self, multicall, pools=None):
+        """queues the calls of the changed vaults, vaults whose state is carried forward get None as indices"""
+        vault_calls = []
+        for str_pool, str_manager, str_contract in self.vaults(pools):
+            entry = self.state["vaults"].get(self.vault_key(str_pool, str_manager, str_contract))
+            if self.unchanged(entry, str_contract, self.config['uni_pools'][str_pool]) \
+                    and self.complete(entry, str_manager):
+                vault_calls.append((str_pool, str_manager, str_contract, None))
+            else:
+                vault_calls.append((str_pool, str_manager, str_contract,
+                                    self.queue_vault_state(str_pool, str_manager, str_contract, multicall)))
+        carried = len([indices for *vault, indices in vault_calls if indices is None])
+        TELEMETRY.count("incremental_vaults", carried, result="carried")
+        TELEMETRY.count("incremental_vaults", len(vault_calls) - carried, result="read")
+        print("log: {} of {} vaults read, {} carried forward".format(
+            len(vault_calls) - carried, len(vault_calls), carried))
+        return vault_calls
+
+    def complete(self, entry, str_manager):
+        """whether a stored vault entry holds everything a row needs, entries of older versions may not"""
+        return "positions" in entry and set(self.vault_calls(str_manager)) <= set(entry["state"])
+
+    def queue_vault_positions(self, multicall, str_pool, str_manager, str_contract, dict_indices, results):
+        """positions of vaults whose state is carried forward are carried as well, they get None as indices"""
+        if dict_indices is None:
+            return None
+        return super().queue_vault_positions(multicall, str_pool, str_manager, str_contract, dict_indices, results)
+
+    def position_state(self, str_pool, str_manager, str_contract, position_indices, results):
+        entry = self.state["vaults"][self.vault_key(str_pool, str_manager, str_contract)]
+        if position_indices is None:
+            return entry["positions"]
+        entry["positions"] = super().position_state(str_pool, str_manager, str_contract, position_indices, results)
+        return entry["positions"]
+
+    def vault_state(self, str_pool, str_manager, str_contract, dict_indices, results):
+        key = self.vault_key(str_pool, str_manager, str_contract)
+        if dict_indices is None:
+            return self.state["vaults"][key]["state"]
+        state = super().vault_state(str_pool, str_manager, str_contract, dict_indices, results)
+        self.state["vaults"][key] = {"block": self.block, "state": state}
+        return state
+
+    def save(self, pools=None):
+        """persists the state of this run: carried state is now known to hold up to the run's block, the state of
+        vaults and pools which failed to be read is dropped, so that they are read again on the next run"""
+        for vault in self.vaults(pools):
+            key = self.vault_key(*vault)
+            entry = self.state["vaults"].get(key)
+            if entry is not None and entry["block"] != self.block:
+                if self.unchanged(entry, vault[2], self.config['uni_pools'][vault[0]]):
+                    entry["block"] = self.block
+                else:
+                    del self.state["vaults"][key]
+        with self.pool_registry.lock:
+            pool_states = dict(self.pool_registry.states.get(self.block, {}))
+        for address in set(address.lower() for address in self.pool_addresses(pools).values()):
+            if address in pool_states:
+                self.state["pools"][address] = {"block": self.block, "state": pool_states[address]}
+            else:
+                self.state["pools"].pop(address, None)
+        helper.write_atomic(self.state_path, json.dumps(self.state))
+        since = self.since()
+        if self.subscription is not None and since is not None:
+            self.subscription.prune(since)
+        return
+
+    def subscribe(self, url, pools=None):
+        """collects the logs of the vaults and pools through a websocket subscription from now on"""
+        self.subscription = LogSubscription(url, self.addresses(pools)).start()
+        return self.subscription
+
+    def unsubscribe(self):
+        if self.subscription is not None:
+            self.subscription.stop()
+            self.subscription = None
+        return
+
+
+class LogSubscription:
+    """Subscribes to the logs of the given addresses over a websocket (eth_subscribe) in a background thread.
+    All logs of blocks after `since`, the block at which the subscription started, are collected.
+    A lost connection is re-established after RECONNECT seconds, only the blocks after the new subscription
+    are covered then"""
+
+    RECONNECT = 5
+    # seconds after which a silent connection checks whether the subscription was stopped
+    POLL = 1
+
+    def __init__(self, url, addresses):
+        self.url = url
+        self.addresses = [Web3.toChecksumAddress(address) for address in addresses]
+        self.since = None
+        self.logs = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncio.run, args=(self.listen(),), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.POLL + 1)
+        return
+
+    def covers(self, start):
+        """whether all logs from block start on were received"""
+        with self.lock:
+            return self.since is not None and self.since < start
+
+    def get_logs(self, start, end):
+        """(address, block, first topic) of the received logs of blocks start to end"""
+        with self.lock:
+            return [log for log in self.logs if start <= log[1] <= end]
+
+    def prune(self, block):
+        """drops the logs of blocks up to block, no run needs them anymore"""
+        with self.lock:
+            self.logs = [log for log in self.logs if log[1] > block]
+        return
+
+    async def listen(self):
+        while not self.stopping.is_set():
+            try:
+                async with websockets.connect(self.url) as websocket:
+                    await self.subscribe(websocket)
+                    while not self.stopping.is_set():
+                        try:
+                            message = json.loads(await asyncio.wait_for(websocket.recv(), timeout=self.POLL))
+                        except asyncio.TimeoutError:
+                            continue
+                        self.handle(message)
+            except Exception as e:
+                with self.lock:
+                    self.since = None
+                print("log: log subscription at {} lost, reconnecting in {}s ({!r})".format(
+                    self.url, self.RECONNECT, e))
+                await asyncio.sleep(self.RECONNECT)
+        return
+
+    async def subscribe(self, websocket):
+        """subscribes first and asks for the block number second, so that every later block is covered"""
+        await websocket.send(json.dumps({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe",
+                                         "params": ["logs", {"address": self.addresses}]}))
+        await websocket.send(json.dumps({"jsonrpc": "2.0", "id": 2, "method": "eth_blockNumber", "params": []}))
+        print("log: subscribed to the logs of {} addresses at {}".format(len(self.addresses), self.url))
+        return
+
+    def handle(self, message):
+        if "error" in message:
+            raise RuntimeError(message["error"])
+        if message.get("id") == 2:
+            with self.lock:
+                self.since = int(message["result"], 16)
+        elif message.get("method") == "eth_subscription":
+            log = message["params"]["result"]
+            with self.lock:
+                self.logs.append((log["address"], int(log["blockNumber"], 16),
+                                  log["topics"][0] if log["topics"] else None))
+        return
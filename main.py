@@ -1,9 +1,18 @@
 import os
 import json
-import pandas as pd
+import cProfile
+import argparse
 
-import query
 import helper
+import query
+import tokens
+import analytics
+import async_query
+import backfill
+import incremental
+import scheduler
+import storage
+from telemetry import TELEMETRY
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(ROOT_DIR, 'query_config.json')
@@ -14,22 +23,108 @@ except FileNotFoundError:
     print("log: config file not found")
 
 
-def save_df(df):
-    """takes a dataframe as an argument and saves it somewhere or so"""
-    spreadsheet = helper.Sheets("v3-optimizer-data")
-    old_df = spreadsheet.get_df()
-    if not old_df.empty:
-        new_df = pd.concat([old_df, df])
-    else:
-        new_df = df
-
-    new_df = new_df.convert_dtypes()
-    spreadsheet.write_df(new_df)
-    print("log: new dataframe written into google spreadsheet: {}".format(spreadsheet.sheet_name))
+def save_df(df, backend=None):
+    """takes a dataframe as an argument and appends its new rows to the configured storage backend"""
+    if backend is None:
+        backend = storage.get_storage(config)
+    with TELEMETRY.span("phase", phase="save"):
+        backend.append(df)
     return
 
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="compare positions of V3 managers")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="collect asynchronously with at most N concurrent requests per endpoint, 0 runs serially")
+    parser.add_argument("--backfill", type=float, default=0, metavar="DAYS",
+                        help="replay snapshots at historical blocks over the last DAYS days instead of one snapshot")
+    parser.add_argument("--step", type=int, default=3600,
+                        help="seconds between two backfilled snapshots")
+    parser.add_argument("--workers", type=int, default=backfill.Backfill.WORKERS,
+                        help="blocks backfilled in parallel")
+    parser.add_argument("--schedule", action="store_true",
+                        help="keep running and collect snapshots on the configured cadences")
+    parser.add_argument("--interval", type=int, default=None,
+                        help="seconds between two scheduled snapshots of pools without their own cadence")
+    parser.add_argument("--analytics", metavar="CSV",
+                        help="compute manager comparison metrics over the stored history and write them to CSV")
+    parser.add_argument("--incremental", action="store_true",
+                        help="re-read only vaults whose vault or pool emitted events since their last read")
+    parser.add_argument("--ws", nargs="+", metavar="[CHAIN=]URL",
+                        help="websocket RPC endpoints (one per chain, ethereum without CHAIN=) the scheduler "
+                             "subscribes to for the logs of the incremental mode")
+    parser.add_argument("--profile", nargs="?", const="profile.prof", metavar="PATH",
+                        help="run under cProfile and dump its stats to PATH (default profile.prof)")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="write the run's counters and timings in the Prometheus text format to PATH")
+    args = parser.parse_args()
+    if args.ws and not args.schedule:
+        parser.error("--ws requires --schedule")
+    args.ws = ws_urls(parser, args.ws or [])
+    if args.incremental and args.concurrency > 0:
+        parser.error("--incremental runs serially, it cannot be combined with --concurrency")
+    return args
+
+
+def ws_urls(parser, values):
+    """{chain: websocket url} of the --ws values"""
+    urls = {}
+    for value in values:
+        chain, _, url = value.partition("=")
+        if not url or "://" in chain:
+            chain, url = helper.DEFAULT_CHAIN, value
+        if chain.lower() not in query.Query.chains(config):
+            parser.error("--ws for {}, which has no pools in the config".format(chain))
+        urls[chain.lower()] = url
+    return urls
+
+
 def main():
-    df = query.Query(config).compile()
+    args = parse_args()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print("log: profile written to {}, inspect it with python -m pstats".format(args.profile))
+    return
+
+
+def run(args):
+    """one-shot runs end with a telemetry summary, the scheduler writes one per tick"""
+    if args.schedule:
+        scheduler.Scheduler(config, interval=args.interval, metrics_path=args.metrics,
+                            incremental_mode=args.incremental, ws_urls=args.ws).run()
+        return
+    try:
+        collect(args)
+    finally:
+        TELEMETRY.finish(prometheus_path=args.metrics)
+    return
+
+
+def collect(args):
+    if args.analytics:
+        token_registry = tokens.TokenRegistry(helper.Blockchain("Ethereum"))
+        metrics = analytics.Analytics(storage.get_storage(config), token_registry.tokens).compute()
+        metrics.to_csv(args.analytics, index=False)
+        return
+    if args.backfill > 0:
+        backend = storage.get_storage(config)
+        for chain in query.Query.chains(config):
+            backfill.Backfill.last_days(config, args.backfill, step=args.step, workers=args.workers, backend=backend,
+                                        chain=chain).run()
+        return
+    if args.incremental:
+        df = query.MultiChainQuery(config, incremental.IncrementalQuery).compile()
+    elif args.concurrency > 0:
+        df = query.MultiChainQuery(config, async_query.AsyncQuery, concurrency=args.concurrency).compile()
+    else:
+        df = query.MultiChainQuery(config).compile()
     save_df(df)
     return
 
@@ -0,0 +1,122 @@
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+from web3._utils.abi import get_abi_output_types
+
+from telemetry import TELEMETRY
+
+
+class MulticallError(Exception):
+    """raised when a result is used whose call reverted, returned no data or could not be sent"""
+
+
+class CallFailure:
+    """placeholder in the results for a call which failed, so that one failing call does not fail the others"""
+
+    def __init__(self, call, reason):
+        self.fn_name = call["fn_name"]
+        self.target = call["target"]
+        self.reason = reason
+
+    def __repr__(self):
+        return "call {} on {} failed ({})".format(self.fn_name, self.target, self.reason)
+
+
+class Multicall:
+    """Collects contract calls and sends them to chain through Multicall3's aggregate3 method,
+    so that all calls of a run are answered in a few round trips and read from the same block"""
+
+    # Multicall3 is deployed at the same address on every EVM chain
+    ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+    # blocks Multicall3 was deployed at, earlier blocks cannot be read through it
+    DEPLOYMENT_BLOCKS = {"ethereum": 14353601, "polygon": 25770160, "arbitrum": 7654707, "optimism": 4286263}
+    AGGREGATE3_SELECTOR = Web3.keccak(text="aggregate3((address,bool,bytes)[])")[:4]
+    BATCH_SIZE = 200
+
+    def __init__(self, w3, block_identifier="latest", batch_size=None):
+        self.w3 = w3
+        self.block_identifier = block_identifier
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.calls = []
+        self.indices = {}
+
+    def add(self, contract_instance, fn_name, *args):
+        """queues a call and returns its index in the result list of execute(),
+        identical calls (e.g. of two config keys aliasing one pool) are only queued once"""
+        call_data = contract_instance.encodeABI(fn_name=fn_name, args=list(args))
+        key = (contract_instance.address, call_data)
+        if key in self.indices:
+            return self.indices[key]
+        fn_abi = [item for item in contract_instance.abi
+                  if item.get("type") == "function" and item.get("name") == fn_name][0]
+        self.indices[key] = len(self.calls)
+        self.calls.append({
+            "target": contract_instance.address,
+            "fn_name": fn_name,
+            "call_data": call_data,
+            "output_types": get_abi_output_types(fn_abi),
+        })
+        return len(self.calls) - 1
+
+    def pin_block(self):
+        """resolves 'latest' into a block number, so that every batch reads the same state"""
+        if self.block_identifier == "latest":
+            self.block_identifier = self.w3.eth.block_number
+        return self.block_identifier
+
+    def chunks(self):
+        """splits the queued calls into chunks of batch_size calls"""
+        return [self.calls[i:i + self.batch_size] for i in range(0, len(self.calls), self.batch_size)]
+
+    def execute(self):
+        """sends all queued calls chunk by chunk and returns their decoded results in order,
+        calls of a chunk which could not be sent are returned as CallFailure"""
+        results = []
+        chunks = self.chunks()
+        for chunk in chunks:
+            try:
+                block = self.pin_block()
+                return_data = self.w3.eth.call({"to": self.ADDRESS, "data": self.encode(chunk)}, block)
+            except Exception as e:
+                print("log: multicall batch of {} calls failed ({})".format(len(chunk), e))
+                results.extend(CallFailure(call, e) for call in chunk)
+                continue
+            results.extend(self.decode(chunk, return_data))
+        print("log: {} calls answered in {} multicall batches at block {}".format(
+            len(self.calls), len(chunks), self.block_identifier))
+        TELEMETRY.count("multicall_calls", len(self.calls))
+        TELEMETRY.count("multicall_batches", len(chunks))
+        self.clear()
+        return results
+
+    @staticmethod
+    def check(result):
+        """returns the result, or raises MulticallError if its call failed"""
+        if isinstance(result, CallFailure):
+            raise MulticallError(repr(result))
+        return result
+
+    def clear(self):
+        self.calls = []
+        self.indices = {}
+        return
+
+    def encode(self, chunk):
+        calls = [(call["target"], True, Web3.toBytes(hexstr=call["call_data"])) for call in chunk]
+        return Web3.toHex(self.AGGREGATE3_SELECTOR + encode_abi(["(address,bool,bytes)[]"], [calls]))
+
+    def decode(self, chunk, return_data):
+        (answers,) = decode_abi(["(bool,bytes)[]"], bytes(return_data))
+        results = []
+        for call, (success, data) in zip(chunk, answers):
+            if not success or len(data) == 0:
+                results.append(CallFailure(call, "reverted"))
+                continue
+            try:
+                values = decode_abi(call["output_types"], data)
+            except Exception as e:
+                results.append(CallFailure(call, e))
+                continue
+            values = [Web3.toChecksumAddress(value) if output_type == "address" else value
+                      for output_type, value in zip(call["output_types"], values)]
+            results.append(values[0] if len(values) == 1 else values)
+        return results
@@ -0,0 +1,112 @@
+from decimal import Decimal, DivisionByZero, InvalidOperation, localcontext
+
+import numpy as np
+
+# significant digits of intermediate results, enough for uint256 amounts times prices
+PRECISION = 100
+# 10 ** -decimals of every possible token, precomputed once instead of per conversion, multiplying by them is exact
+SCALES = [Decimal(10) ** -decimals for decimals in range(78)]
+# fixed point bases of the uni pool's square root prices and fee growth, fee growth wraps around like a uint256
+Q96 = 2 ** 96
+Q128 = 2 ** 128
+UINT256 = 2 ** 256
+TICK_BASE = Decimal("1.0001")
+
+
+def as_decimals(values):
+    """object array of exact Decimals from python ints or their strings, raw amounts keep all their digits"""
+    return np.array([Decimal(value) for value in values], dtype=object)
+
+
+def as_prices(prices):
+    """object array of Decimals from float prices, taking the shortest decimal representation of each float"""
+    return np.array([Decimal(repr(float(price))) for price in prices], dtype=object)
+
+
+def scales(decimals):
+    return np.array([SCALES[int(value)] for value in decimals], dtype=object)
+
+
+def vault_values(total_supply, decimals, balance_0, decimals_0, price_0, balance_1, decimals_1, price_1):
+    """converts the raw integer amounts of a batch of vaults into token units and USD values in one pass.
+    All arithmetic is exact Decimal math on object arrays, every result is rounded to float once at the end.
+    Returns {column: float64 array}, vault token prices of vaults without supply are NaN"""
+    with localcontext() as context:
+        context.prec = PRECISION
+        context.traps[DivisionByZero] = False
+        context.traps[InvalidOperation] = False
+        supply = as_decimals(total_supply) * scales(decimals)
+        units_0 = as_decimals(balance_0) * scales(decimals_0)
+        units_1 = as_decimals(balance_1) * scales(decimals_1)
+        value_0 = units_0 * as_prices(price_0)
+        value_1 = units_1 * as_prices(price_1)
+        vault_value = value_0 + value_1
+        token_price = vault_value / supply
+
+    values = {
+        "totalSupply": supply,
+        "token0Balance": units_0,
+        "token0Value": value_0,
+        "token1Balance": units_1,
+        "token1Value": value_1,
+        "vaultValue": vault_value,
+        "vaultTokenPrice": token_price,
+    }
+    values = {column: array.astype(float) for column, array in values.items()}
+    values["vaultTokenPrice"][values["totalSupply"] == 0] = np.nan
+    return values
+
+
+def sqrt_ratios(ticks):
+    """square root of the price 1.0001 ** tick at every tick, in raw token amounts"""
+    return np.array([(TICK_BASE ** int(tick)).sqrt() for tick in ticks], dtype=object)
+
+
+def position_amounts(liquidity, sqrt_price_x96, tick_lower, tick_upper):
+    """raw token amounts held by a batch of uni positions at the pool's current square root price, exact Decimals.
+    Positions below the price hold only token1, positions above it only token0"""
+    with localcontext() as context:
+        context.prec = PRECISION
+        context.traps[DivisionByZero] = False
+        context.traps[InvalidOperation] = False
+        lower = sqrt_ratios(tick_lower)
+        upper = sqrt_ratios(tick_upper)
+        price = np.minimum(np.maximum(as_decimals(sqrt_price_x96) / Q96, lower), upper)
+        liquidity = as_decimals(liquidity)
+        amount_0 = liquidity * (upper - price) / (price * upper)
+        amount_1 = liquidity * (price - lower)
+    return amount_0, amount_1
+
+
+def uncollected_fees(liquidity, tick, tick_lower, tick_upper, fee_growth_global, outside_lower, outside_upper,
+                     inside_last, tokens_owed):
+    """raw fees of one token owed to a batch of uni positions: tokens owed at their last update plus the fees
+    accrued since, from the fee growth inside their ticks as the pool computes it. Exact python integers"""
+    below = np.where(tick >= tick_lower, outside_lower, fee_growth_global - outside_lower)
+    above = np.where(tick < tick_upper, outside_upper, fee_growth_global - outside_upper)
+    inside = (fee_growth_global - below - above) % UINT256
+    return tokens_owed + liquidity * ((inside - inside_last) % UINT256) // Q128
+
+
+def position_values(amount_0, amount_1, fees_0, fees_1, decimals_0, price_0, decimals_1, price_1):
+    """converts raw position amounts and fees into token units and USD values in one pass, like vault_values.
+    Returns {column: float64 array}"""
+    with localcontext() as context:
+        context.prec = PRECISION
+        scale_0 = scales(decimals_0)
+        scale_1 = scales(decimals_1)
+        price_0 = as_prices(price_0)
+        price_1 = as_prices(price_1)
+        units_0 = np.array(amount_0, dtype=object) * scale_0
+        units_1 = np.array(amount_1, dtype=object) * scale_1
+        fee_units_0 = as_decimals(fees_0) * scale_0
+        fee_units_1 = as_decimals(fees_1) * scale_1
+        values = {
+            "amount0": units_0,
+            "amount1": units_1,
+            "value": units_0 * price_0 + units_1 * price_1,
+            "fees0": fee_units_0,
+            "fees1": fee_units_1,
+            "feesValue": fee_units_0 * price_0 + fee_units_1 * price_1,
+        }
+    return {column: array.astype(float) for column, array in values.items()}
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+
+from pycoingecko import CoinGeckoAPI
+
+import helper
+from telemetry import TELEMETRY
+
+
+class PriceOracle:
+    """Prices tokens in USD. All tokens of a run are priced together, results are cached on disk with a TTL,
+    so that repeated runs within the window skip the network. Sources are asked in order for the tokens
+    that are still missing, e.g. CoinGecko first and on-chain pool prices when CoinGecko is unavailable"""
+
+    CACHE_PATH = os.path.join(helper.ROOT_DIR, '.price_cache.json')
+    TTL = 300
+    # oldest cached price that may still anchor prices derived relative to it
+    MAX_STALE = 3600
+
+    def __init__(self, sources, ttl=None, cache_path=None, max_stale=None):
+        self.sources = sources
+        self.ttl = ttl if ttl is not None else self.TTL
+        self.max_stale = max_stale if max_stale is not None else self.MAX_STALE
+        self.cache_path = cache_path or self.CACHE_PATH
+        try:
+            with open(self.cache_path, 'r') as f:
+                self.cache = json.load(f)
+        except FileNotFoundError:
+            self.cache = {}
+
+    def get_prices(self, contracts):
+        """returns {lowercase contract: usd price} for all given contracts that any source could price"""
+        now = time.time()
+        contracts = set(contract.lower() for contract in contracts)
+        prices = {contract: self.cache[contract][0] for contract in contracts
+                  if contract in self.cache and now - self.cache[contract][1] < self.ttl}
+        missing = contracts - set(prices)
+        TELEMETRY.count("price_lookups", len(prices), result="hit")
+        TELEMETRY.count("price_lookups", len(missing), result="miss")
+        if missing:
+            # stale prices may still anchor sources which derive prices relative to other tokens, as long as they
+            # are recent enough, derived prices are cached as fresh
+            stale = {contract: entry[0] for contract, entry in self.cache.items() if now - entry[1] < self.max_stale}
+            for source in self.sources:
+                with TELEMETRY.span("price_source", source=source.NAME):
+                    found = source.get_prices(missing, dict(stale, **prices))
+                for contract, price in found.items():
+                    prices[contract] = price
+                    self.cache[contract] = [price, now, source.NAME]
+                missing = missing - set(found)
+                if not missing:
+                    break
+            helper.write_atomic(self.cache_path, json.dumps(self.cache, indent=2))
+        if missing:
+            print("log: no price found for {}".format(", ".join(sorted(missing))))
+        return prices
+
+    def get_price(self, contract):
+        return self.get_prices([contract])[contract.lower()]
+
+
+class CoinGeckoSource:
+    """prices all requested tokens with one CoinGecko simple/price request"""
+
+    NAME = "coingecko"
+    API_URL = "https://api.coingecko.com/api/v3/"
+    TIMEOUT = 10
+
+    def __init__(self, contracts):
+        self.contracts = contracts
+
+    def get_prices(self, contracts, known):
+        cg = CoinGeckoAPI()
+        cg.api_base_url = self.API_URL
+        cg.request_timeout = self.TIMEOUT
+        ids = {self.contracts[contract][0]: contract for contract in contracts
+               if contract in self.contracts and self.contracts[contract][0] is not None}
+        if not ids:
+            return {}
+        try:
+            with TELEMETRY.span("coingecko", method="simple/price"):
+                TELEMETRY.count("coingecko_requests", method="simple/price")
+                result = cg.get_price(ids=sorted(ids), vs_currencies='usd')
+        except Exception as e:
+            print("log: coingecko unavailable ({}), falling back".format(e))
+            return {}
+        print("log: {} prices retrieved from coingecko".format(len(result)))
+        return {ids[cg_id]: value['usd'] for cg_id, value in result.items() if cg_id in ids}
+
+
+class UniswapPoolSource:
+    """derives prices from the slot0 sqrtPriceX96 of uni pools, relative to a token whose price is known
+    (from another source, the stale cache or the stablecoin anchors)"""
+
+    NAME = "uniswap"
+    ANCHORS = ["usd-coin", "tether", "dai"]
+
+    def __init__(self, registry, contracts, pools):
+        """registry is the PoolRegistry holding metadata and state of the pools, pools a list of uni pool addresses
+        and contracts the token registry's mapping to look up the anchors"""
+        self.registry = registry
+        self.contracts = contracts
+        self.pools = sorted(set(pool.lower() for pool in pools))
+
+    def get_prices(self, contracts, known):
+        known = dict(known)
+        prices = {}
+        for contract, (cg_id, decimals) in self.contracts.items():
+            if cg_id in self.ANCHORS:
+                known[contract] = 1.0
+                if contract in contracts:
+                    prices[contract] = 1.0
+
+        # tokens come from the cached metadata, sqrt prices from the state of the current run
+        metadata = self.registry.get_metadata(self.pools)
+        state = self.registry.get_state(list(metadata))
+        pools = []
+        for pool, pool_metadata in metadata.items():
+            if pool not in state:
+                continue
+            token_1_per_token_0 = (state[pool]["slot0"][0] / 2 ** 96) ** 2 \
+                * 10 ** (pool_metadata["decimals0"] - pool_metadata["decimals1"])
+            pools.append((pool_metadata["token0"].lower(), pool_metadata["token1"].lower(), token_1_per_token_0))
+
+        # walk through the pools, deriving missing prices from their counterparts, until nothing changes
+        progress = True
+        while progress:
+            progress = False
+            for token_0, token_1, token_1_per_token_0 in pools:
+                if token_0 in prices and token_1 not in prices and token_1_per_token_0 > 0:
+                    prices[token_1] = known[token_1] = known[token_0] / token_1_per_token_0
+                elif token_1 in prices and token_0 not in prices:
+                    prices[token_0] = known[token_0] = known[token_1] * token_1_per_token_0
+                elif token_0 in known and token_1 in contracts and token_1 not in prices and token_1_per_token_0 > 0:
+                    prices[token_1] = known[token_1] = known[token_0] / token_1_per_token_0
+                elif token_1 in known and token_0 in contracts and token_0 not in prices:
+                    prices[token_0] = known[token_0] = known[token_1] * token_1_per_token_0
+                else:
+                    continue
+                progress = True
+        prices = {contract: price for contract, price in prices.items() if contract in contracts}
+        print("log: {} prices derived from uni pools".format(len(prices)))
+        return prices
@@ -0,0 +1,120 @@
+import os
+import json
+import threading
+
+from cachetools import LRUCache
+from web3 import Web3
+
+import helper
+from multicall import Multicall, CallFailure
+from telemetry import TELEMETRY
+
+
+class PoolRegistry:
+    """Reads every distinct uni pool once, however many config keys and managers share it.
+    The immutable metadata of a pool (tokens, fee tier and token decimals) is read the first time the pool is seen
+    and persisted on disk (one cache per chain), the mutable state (slot0, liquidity and the global fee growth)
+    is kept per block, i.e. per run"""
+
+    CACHE_PATH = os.path.join(helper.ROOT_DIR, '.pool_cache.json')
+    ABI = "0x8f8ef111b67c04eb1641f5ff19ee54cda062f163"
+    STATE = ["slot0", "liquidity", "feeGrowthGlobal0X128", "feeGrowthGlobal1X128"]
+    # blocks whose state is kept, backfill workers run on several blocks at once
+    STATE_BLOCKS = 16
+
+    def __init__(self, bc, token_registry, cache_path=None):
+        self.bc = bc
+        self.token_registry = token_registry
+        self.cache_path = cache_path or helper.chain_path(self.CACHE_PATH, bc.blockchain)
+        try:
+            with open(self.cache_path, 'r') as f:
+                self.metadata = json.load(f)
+        except FileNotFoundError:
+            self.metadata = {}
+        self.states = LRUCache(maxsize=self.STATE_BLOCKS)
+        self.block = None
+        self.lock = threading.Lock()
+
+    def contract(self, pool):
+        return self.bc.create_contract(contract_address=Web3.toChecksumAddress(pool), abi_address=self.ABI)
+
+    def get_metadata(self, pools):
+        """returns {lowercase pool address: metadata} of the given pools, pools never seen before are read in
+        one batch of token and fee calls, their tokens are resolved by the token registry.
+        Pools which could not be read are left out"""
+        pools = sorted(set(pool.lower() for pool in pools))
+        missing = [pool for pool in pools if pool not in self.metadata]
+        TELEMETRY.count("pool_metadata_lookups", len(pools) - len(missing), result="hit")
+        TELEMETRY.count("pool_metadata_lookups", len(missing), result="miss")
+        if missing:
+            multicall = Multicall(self.bc.get_w3())
+            indices = {pool: [multicall.add(self.contract(pool), fn_name) for fn_name in ("token0", "token1", "fee")]
+                       for pool in missing}
+            results = multicall.execute()
+            pool_tokens = {}
+            for pool, pool_indices in indices.items():
+                values = [results[index] for index in pool_indices]
+                failures = [value for value in values if isinstance(value, CallFailure)]
+                if failures:
+                    print("log: metadata of uni pool {} unavailable ({})".format(pool, failures[0]))
+                    continue
+                pool_tokens[pool] = values
+
+            tokens = self.token_registry.resolve([token for token_0, token_1, fee in pool_tokens.values()
+                                                  for token in (token_0, token_1)])
+            for pool, (token_0, token_1, fee) in pool_tokens.items():
+                if token_0.lower() not in tokens or token_1.lower() not in tokens:
+                    print("log: token decimals of uni pool {} unavailable".format(pool))
+                    continue
+                self.metadata[pool] = {
+                    "token0": token_0,
+                    "token1": token_1,
+                    "fee": fee,
+                    "decimals0": tokens[token_0.lower()][1],
+                    "decimals1": tokens[token_1.lower()][1],
+                }
+            helper.write_atomic(self.cache_path, json.dumps(self.metadata, indent=2))
+            print("log: metadata of {} uni pools read".format(len(pool_tokens)))
+        return {pool: self.metadata[pool] for pool in pools if pool in self.metadata}
+
+    def queue_state(self, multicall, pools):
+        """queues the state calls once per distinct pool and returns {lowercase pool address: result indices}"""
+        return {pool: [multicall.add(self.contract(pool), fn_name) for fn_name in self.STATE]
+                for pool in sorted(set(pool.lower() for pool in pools))}
+
+    def set_state(self, block, indices, results):
+        """keeps the state read at block, which becomes the block of the current run"""
+        states = {}
+        for pool, pool_indices in indices.items():
+            values = [results[index] for index in pool_indices]
+            if not any(isinstance(value, CallFailure) for value in values):
+                states[pool] = dict(zip(self.STATE, values))
+        self.put_state(block, states)
+        return
+
+    def put_state(self, block, states):
+        """keeps {lowercase pool address: state} as the state at block, e.g. state carried over from an earlier
+        block by the incremental mode, and makes block the block of the current run"""
+        with self.lock:
+            self.states.setdefault(block, {}).update(states)
+            self.block = block
+        return
+
+    def get_state(self, pools, block=None):
+        """state of the given pools at block (the current run's block by default),
+        pools not read yet at that block are read in one batch"""
+        pools = sorted(set(pool.lower() for pool in pools))
+        block = block or self.block
+        with self.lock:
+            state = dict(self.states.get(block, {})) if block is not None else {}
+        missing = [pool for pool in pools if pool not in state]
+        TELEMETRY.count("pool_state_lookups", len(pools) - len(missing), result="hit")
+        TELEMETRY.count("pool_state_lookups", len(missing), result="miss")
+        if missing:
+            multicall = Multicall(self.bc.get_w3(), block or "latest")
+            indices = self.queue_state(multicall, missing)
+            results = multicall.execute()
+            self.set_state(multicall.block_identifier, indices, results)
+            with self.lock:
+                state = dict(self.states.get(multicall.block_identifier, {}))
+        return {pool: state[pool] for pool in pools if pool in state}
@@ -0,0 +1,107 @@
+import numpy as np
+from web3 import Web3
+
+import numeric
+from multicall import Multicall
+
+# results of a pool's positions(key), the state of a position at its last update
+POSITION_FIELDS = ["liquidity", "feeGrowthInside0LastX128", "feeGrowthInside1LastX128", "tokensOwed0", "tokensOwed1"]
+# feeGrowthOutside0X128 and feeGrowthOutside1X128 in the results of a pool's ticks(tick)
+TICK_FEE_GROWTH = slice(2, 4)
+
+
+def position_key(owner, tick_lower, tick_upper):
+    """key of a position in its pool, keccak256(abi.encodePacked(owner, tickLower, tickUpper))"""
+    return Web3.solidityKeccak(["address", "int24", "int24"], [Web3.toChecksumAddress(owner), tick_lower, tick_upper])
+
+
+def queue(multicall, pool_contract, owner, ticks):
+    """queues the reads of the positions of owner at the given (name, lower tick, upper tick), the position
+    and both its ticks, and returns their result indices. Ticks shared by several positions are read once"""
+    return [(name, tick_lower, tick_upper,
+             multicall.add(pool_contract, "positions", position_key(owner, tick_lower, tick_upper)),
+             multicall.add(pool_contract, "ticks", tick_lower),
+             multicall.add(pool_contract, "ticks", tick_upper))
+            for name, tick_lower, tick_upper in ticks]
+
+
+def state(indices, results):
+    """the positions queued by queue as a list of dicts, raises MulticallError if one of their calls failed"""
+    positions = []
+    for name, tick_lower, tick_upper, position_index, lower_index, upper_index in indices:
+        position = dict(zip(POSITION_FIELDS, Multicall.check(results[position_index])))
+        position.update(
+            name=name,
+            tickLower=tick_lower,
+            tickUpper=tick_upper,
+            feeGrowthOutsideLower=list(Multicall.check(results[lower_index])[TICK_FEE_GROWTH]),
+            feeGrowthOutsideUpper=list(Multicall.check(results[upper_index])[TICK_FEE_GROWTH]),
+        )
+        positions.append(position)
+    return positions
+
+
+def decompose(snapshot, vault_positions, pool_states):
+    """splits the positions of all vaults into in range and out of range liquidity and value and adds their
+    uncollected fees, with the tick math of numeric.py over all positions at once. vault_positions holds
+    (row index, lowercase pool address, positions) of the vaults, pool_states the slot0 and fee growth of the
+    pools. The sums per vault are written into the snapshot rows, in range value also as share of the vault value"""
+    rows, pools, positions = [], [], []
+    for index, pool, vault in vault_positions:
+        snapshot.set(index, positionCount=len(vault))
+        rows.extend([index] * len(vault))
+        pools.extend([pool] * len(vault))
+        positions.extend(vault)
+    if not positions:
+        return
+
+    def position_column(name, index=None):
+        return np.array([int(position[name] if index is None else position[name][index])
+                         for position in positions], dtype=object)
+
+    def pool_column(name, index=None):
+        return np.array([int(pool_states[pool][name] if index is None else pool_states[pool][name][index])
+                         for pool in pools], dtype=object)
+
+    rows = np.array(rows)
+    liquidity = position_column("liquidity")
+    tick_lower = position_column("tickLower").astype(np.int64)
+    tick_upper = position_column("tickUpper").astype(np.int64)
+    sqrt_price_x96 = pool_column("slot0", 0)
+    tick = pool_column("slot0", 1).astype(np.int64)
+    in_range = (tick >= tick_lower) & (tick < tick_upper)
+
+    amount_0, amount_1 = numeric.position_amounts(liquidity, sqrt_price_x96, tick_lower, tick_upper)
+    fees = [numeric.uncollected_fees(liquidity, tick, tick_lower, tick_upper,
+                                     pool_column("feeGrowthGlobal{}X128".format(token)),
+                                     position_column("feeGrowthOutsideLower", token),
+                                     position_column("feeGrowthOutsideUpper", token),
+                                     position_column("feeGrowthInside{}LastX128".format(token)),
+                                     position_column("tokensOwed{}".format(token)))
+            for token in (0, 1)]
+    values = numeric.position_values(amount_0, amount_1, fees[0], fees[1],
+                                     *[snapshot.column(column)[rows] for column in
+                                       ("token0Decimals", "token0Price", "token1Decimals", "token1Price")])
+
+    # sums per vault, positions of a vault are all in the same pool, so that their liquidity adds up
+    targets = np.unique(rows)
+    local = np.searchsorted(targets, rows)
+
+    def total(weights):
+        return np.bincount(local, weights=weights, minlength=len(targets))
+
+    liquidity = liquidity.astype(float)
+    sums = {
+        "inRangeLiquidity": total(np.where(in_range, liquidity, 0.0)),
+        "outOfRangeLiquidity": total(np.where(in_range, 0.0, liquidity)),
+        "inRangeValue": total(np.where(in_range, values["value"], 0.0)),
+        "outOfRangeValue": total(np.where(in_range, 0.0, values["value"])),
+        "uncollectedFees0": total(values["fees0"]),
+        "uncollectedFees1": total(values["fees1"]),
+        "uncollectedFeesValue": total(values["feesValue"]),
+    }
+    for name, array in sums.items():
+        snapshot.column(name)[targets] = array
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snapshot.column("inRangeShare")[targets] = sums["inRangeValue"] / snapshot.column("vaultValue")[targets]
+    return
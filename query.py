@@ -1,12 +1,20 @@
 import time
 import os
 import json
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from pycoingecko import CoinGeckoAPI
+import pandas as pd
 from web3 import Web3
 
 import helper
+import numeric
+import oracle
+import positions
+import schema
+from multicall import Multicall
+from pools import PoolRegistry
+from telemetry import TELEMETRY
+from tokens import TokenRegistry
 
 
 class Query:
@@ -17,298 +25,378 @@ class Query:
     in order to create a comparative view of various providers of UniV3 strategies"""
 
     FILEPATH = "collected_data.csv"
-    # get contract data
     ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
-    CONTRACTS_PATH = os.path.join(ROOT_DIR, 'contracts.json')
-    try:
-        with open(CONTRACTS_PATH, 'r') as f:
-            CONTRACTS = json.load(f)
-    except FileNotFoundError:
-        print("log: contracts file not found")
-
-    def __init__(self, config):
+
+    # adapter spec per manager: ABI shared by its vaults (null for the vault's own ABI) and the calls,
+    # with index paths into their results, which make up the fields of a row, and the lower and upper tick
+    # of every uni position its vaults hold (index paths to arrays for a variable number of positions)
+    MANAGERS_PATH = os.path.join(ROOT_DIR, 'managers.json')
+    with open(MANAGERS_PATH, 'r') as f:
+        MANAGERS = json.load(f)
+
+    # columns of the schema (schema.py) the float columns are converted from. Raw columns hold the integer
+    # amounts read from chain as strings, which together with the decimals reproduce the float columns exactly,
+    # rows of failed vaults only fill timestamp, poolId, manager, status and error
+    RAW_COLUMNS = ["totalSupplyRaw", "vaultDecimals", "token0BalanceRaw", "token0Decimals", "token0Price",
+                   "token1BalanceRaw", "token1Decimals", "token1Price"]
+
+    def __init__(self, config, chain=helper.DEFAULT_CHAIN):
         """config file must have the following dict logic:
         {str_pool_fee: {
             str_v3manager: str_contract_address,
             str_v3manager: str_contract_address,
             },
         str_pool_fee: {...
+        A query covers the pools of one chain, the optional 'chains' key of the config assigns pools to other chains
+        than ethereum, e.g. {"usdc_eth_0.05_polygon": "polygon"}
         """
 
-        self.config = config
-        self.bc = helper.Blockchain("Ethereum")
+        self.chain = chain.lower()
+        self.config = self.for_chain(config, self.chain)
+        self.bc = helper.Blockchain(self.chain)
+        self.token_registry = TokenRegistry(self.bc)
+        self.pool_registry = PoolRegistry(self.bc, self.token_registry)
+        self.oracle = oracle.PriceOracle([
+            oracle.CoinGeckoSource(self.token_registry.tokens),
+            oracle.UniswapPoolSource(self.pool_registry, self.token_registry.tokens,
+                                    [self.config['uni_pools'][str_pool] for str_pool in self.config['query']]),
+        ], cache_path=helper.chain_path(oracle.PriceOracle.CACHE_PATH, self.chain))
+        self.check_aliases()
         return
 
-    def compile(self):
-        """summary function to iterate through config, which eventually compiles the dataframe"""
-        config = self.config['query']
-        uni_pools = self.config['uni_pools']
-        list_df = []
-        for str_pool, dict_managers in config.items():
-            uni_pool_address = Web3.toChecksumAddress(uni_pools[str_pool])
-            token_0_contract, token_1_contract = self.get_uni_pool_tokens(uni_pool_address)
-            token_0_price = self.get_price(token_0_contract)
-            token_1_price = self.get_price(token_1_contract)
+    @staticmethod
+    def chains(config):
+        """all chains the pools of the config are on"""
+        return sorted(set(config.get('chains', {}).get(str_pool, helper.DEFAULT_CHAIN).lower()
+                          for str_pool in config['query']))
+
+    @staticmethod
+    def for_chain(config, chain):
+        """the config limited to the pools of one chain"""
+        chains = config.get('chains', {})
+        return dict(config, query={str_pool: dict_managers for str_pool, dict_managers in config['query'].items()
+                                   if chains.get(str_pool, helper.DEFAULT_CHAIN).lower() == chain})
+
+    def check_aliases(self):
+        """warns about config keys pointing at the same uni pool, their vaults are compared on one pool"""
+        keys = {}
+        for str_pool in self.config['query']:
+            keys.setdefault(self.config['uni_pools'][str_pool].lower(), []).append(str_pool)
+        for address, str_pools in keys.items():
+            if len(str_pools) > 1:
+                print("log: warning, config keys {} alias the same uni pool {}".format(", ".join(str_pools), address))
+        return
+
+    def compile(self, block_identifier="latest", timestamp=None, price_oracle=None, pools=None):
+        """summary function to iterate through config, which eventually compiles the dataframe
+        all pool and vault calls are queued into one multicall, so that they are read from the same block.
+        For historical snapshots pass the block, its timestamp and an oracle serving prices of that time,
+        pools limits the run to some pool ids of the config"""
+        with TELEMETRY.span("phase", phase="pool_metadata"):
+            pool_metadata = self.get_pool_metadata(pools)
+        with TELEMETRY.span("phase", phase="queue"):
+            multicall = Multicall(self.bc.get_w3(), block_identifier)
+            state_calls = self.queue_pools(multicall, pools)
+            vault_calls = self.queue_vaults(multicall, pools)
+        with TELEMETRY.span("phase", phase="multicall"):
+            results = multicall.execute()
+        self.pool_registry.set_state(multicall.block_identifier, state_calls, results)
+
+        # the positions are known from the vault states, they are read in a second batch at the same block
+        with TELEMETRY.span("phase", phase="positions"):
+            position_multicall = Multicall(self.bc.get_w3(), multicall.block_identifier)
+            position_calls = self.queue_positions(position_multicall, vault_calls, results)
+            position_results = position_multicall.execute()
+
+        # price all tokens at once and combine them with the results
+        price_oracle = price_oracle or self.oracle
+        with TELEMETRY.span("phase", phase="prices"):
+            prices = price_oracle.get_prices(self.tokens_of(pool_metadata))
+        with TELEMETRY.span("phase", phase="build_df"):
+            return self.build_df(pool_metadata, prices, vault_calls, results, timestamp,
+                                 position_calls, position_results, multicall.block_identifier)
+
+    def pool_addresses(self, pools=None):
+        """{str_pool: uni pool address} of the config, limited to some pool ids if pools is given"""
+        return {str_pool: self.config['uni_pools'][str_pool] for str_pool in self.config['query']
+                if pools is None or str_pool in pools}
+
+    def get_pool_metadata(self, pools=None):
+        """immutable metadata (tokens, fee tier, decimals) of the uni pool of every config key,
+        {str_pool: metadata}, None for pools whose metadata could not be read"""
+        addresses = self.pool_addresses(pools)
+        metadata = self.pool_registry.get_metadata(addresses.values())
+        pool_metadata = {str_pool: metadata.get(address.lower()) for str_pool, address in addresses.items()}
+        # tokens of pools cached before their tokens were known
+        self.token_registry.resolve(self.tokens_of(pool_metadata))
+        return pool_metadata
+
+    def queue_pools(self, multicall, pools=None):
+        """queues the state of every distinct uni pool of the config once and returns the indices for the registry"""
+        return self.pool_registry.queue_state(multicall, self.pool_addresses(pools).values())
+
+    def vaults(self, pools=None):
+        """(pool, manager, contract) of every vault of the config, limited to some pool ids if pools is given"""
+        return [(str_pool, str_manager, str_contract) for str_pool, dict_managers in self.config['query'].items()
+                if pools is None or str_pool in pools for str_manager, str_contract in dict_managers.items()]
+
+    def queue_vaults(self, multicall, pools=None):
+        """queues state calls for every vault of the config and returns a list of (pool, manager, contract, indices)"""
+        return [(str_pool, str_manager, str_contract,
+                 self.queue_vault_state(str_pool, str_manager, str_contract, multicall))
+                for str_pool, str_manager, str_contract in self.vaults(pools)]
+
+    def queue_vault_state(self, str_pool, str_manager, str_contract, multicall):
+        """queues the calls of a vault, the error instead if they could not be queued, e.g. without its ABI"""
+        try:
+            return self.get_vault_state(str_manager, str_contract, multicall)
+        except Exception as e:
+            print("log: calls of {} vault for uni vault {} not queued ({!r})".format(str_manager, str_pool, e))
+            return e
+
+    def queue_positions(self, multicall, vault_calls, results):
+        """queues the reads of the uni positions of every vault, returns their indices in the order of vault_calls"""
+        return [self.queue_vault_positions(multicall, str_pool, str_manager, str_contract, dict_indices, results)
+                for str_pool, str_manager, str_contract, dict_indices in vault_calls]
+
+    def queue_vault_positions(self, multicall, str_pool, str_manager, str_contract, dict_indices, results):
+        """queues the positions of a vault at the ticks of its state, the error instead if its state is unavailable"""
+        try:
+            state = self.vault_state(str_pool, str_manager, str_contract, dict_indices, results)
+            return positions.queue(multicall, self.pool_registry.contract(self.config['uni_pools'][str_pool]),
+                                   str_contract, self.decode_positions(str_manager, state))
+        except Exception as e:
+            return e
+
+    def position_state(self, str_pool, str_manager, str_contract, position_indices, results):
+        """the positions of a vault, raises if they could not be read"""
+        if isinstance(position_indices, Exception):
+            raise position_indices
+        return positions.state(position_indices, results)
+
+    @staticmethod
+    def tokens_of(pool_metadata):
+        """all tokens of the pools whose metadata is known"""
+        return [metadata[token] for metadata in pool_metadata.values() if metadata is not None
+                for token in ("token0", "token1")]
+
+    def build_df(self, pool_metadata, prices, vault_calls, results, timestamp=None, position_calls=None,
+                 position_results=None, block=None):
+        """combines pool metadata, prices and vault states into the dataframe,
+        a vault whose calls, pool or prices failed becomes a row with its error instead of failing the run.
+        Raw amounts of all vaults are converted into units and values together, with exact math.
+        Given the position reads, the positions of all vaults are decomposed together (positions.py),
+        a vault whose positions are unavailable keeps its row without them"""
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        pool_data = {}
+        for str_pool, metadata in pool_metadata.items():
+            if metadata is None:
+                pool_data[str_pool] = LookupError("metadata of uni pool {} unavailable".format(str_pool))
+                continue
+            try:
+                pool_data[str_pool] = {
+                    "token_0_contract": metadata["token0"],
+                    "token_0_decimals": metadata["decimals0"],
+                    "token_0_price": prices[metadata["token0"].lower()],
+                    "token_1_contract": metadata["token1"],
+                    "token_1_decimals": metadata["decimals1"],
+                    "token_1_price": prices[metadata["token1"].lower()],
+                }
+            except KeyError as e:
+                pool_data[str_pool] = e
             print("log: querying uni vault {}".format(str_pool))
-            for str_manager, str_contract in dict_managers.items():
-                function = self.mapping(str_manager)
-                list_df.append(function(
+
+        snapshot = schema.Snapshot(len(vault_calls))
+        vault_positions = []
+        for vault_index, (str_pool, str_manager, str_contract, dict_indices) in enumerate(vault_calls):
+            try:
+                if isinstance(pool_data[str_pool], Exception):
+                    raise pool_data[str_pool]
+                index = self.vault_row(
+                    snapshot,
                     pool_id=str_pool,
+                    manager=str_manager,
                     contract=str_contract,
-                    token_0_contract=token_0_contract,
-                    token_0_price=token_0_price,
-                    token_1_contract=token_1_contract,
-                    token_1_price=token_1_price,
-                ))
-
-        df = pd.DataFrame(list_df)
-        return df
-
-    def mapping(self, str_manager):
-        dict_map = {
-            "g-uni": self.g_uni_vaults,
-            "gamma": self.gamma_vaults,
-            "lixir": self.lixir_vaults,
-            "charm": self.charm_vaults,
-            "popsicle": self.popsicle_vaults,
-        }
-        return_function = dict_map[str_manager]
-
-        return return_function
-
-    def get_uni_pool_tokens(self, contract):
+                    state=self.vault_state(str_pool, str_manager, str_contract, dict_indices, results),
+                    timestamp=timestamp,
+                    **pool_data[str_pool],
+                )
+            except Exception as e:
+                print("log: {} vault for uni vault {} failed ({!r})".format(str_manager, str_pool, e))
+                self.error_row(snapshot, str_pool, str_manager, e, timestamp)
+                continue
+            if position_calls is None:
+                continue
+            try:
+                vault_positions.append((index, self.config['uni_pools'][str_pool].lower(), self.position_state(
+                    str_pool, str_manager, str_contract, position_calls[vault_index], position_results)))
+            except Exception as e:
+                print("log: positions of {} vault for uni vault {} unavailable ({!r})".format(str_manager, str_pool, e))
+
+        ok = snapshot.column("status") == "ok"
+        values = numeric.vault_values(*[snapshot.column(column)[ok] for column in self.RAW_COLUMNS])
+        for column, array in values.items():
+            snapshot.column(column)[ok] = array
+        if vault_positions:
+            self.decompose(snapshot, vault_positions, block)
+        return snapshot.to_df()
+
+    def decompose(self, snapshot, vault_positions, block):
+        """decomposes the positions of the vaults whose pool state is complete at block"""
+        pool_states = self.pool_registry.get_state(set(pool for index, pool, vault in vault_positions), block)
+        complete = [(index, pool, vault) for index, pool, vault in vault_positions
+                    if set(PoolRegistry.STATE) <= set(pool_states.get(pool, {}))]
+        if len(complete) < len(vault_positions):
+            print("log: positions of {} vaults not decomposed, the state of their pools is unavailable".format(
+                len(vault_positions) - len(complete)))
+        positions.decompose(snapshot, complete, pool_states)
+        return
+
+    def error_row(self, snapshot, str_pool, str_manager, error, timestamp):
+        """writes the row of a vault which could not be read, with its error"""
+        return snapshot.add(timestamp=timestamp, poolId=str_pool, manager=str_manager, chain=self.chain,
+                            status="error", error="{}: {}".format(type(error).__name__, error))
+
+    def failed(self, error, pools=None, timestamp=None):
+        """dataframe of a run which failed as a whole, an error row for every vault"""
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        vaults = self.vaults(pools)
+        snapshot = schema.Snapshot(len(vaults))
+        for str_pool, str_manager, str_contract in vaults:
+            self.error_row(snapshot, str_pool, str_manager, error, timestamp)
+        return snapshot.to_df()
+
+    def get_vault_state(self, str_manager, contract, multicall):
+        """queues all calls of a manager's spec and returns {function name: result index}"""
         # inits
         contract = Web3.toChecksumAddress(contract)
-        abi = "0x8f8ef111b67c04eb1641f5ff19ee54cda062f163"
-        contract_instance = self.bc.create_contract(contract_address=contract, abi_address=abi)
+        contract_instance = self.bc.create_contract(contract_address=contract,
+                                                    abi_address=self.MANAGERS[str_manager]["abi"])
+
+        # queue calls
+        dict_indices = {}
+        for fn_name in self.vault_calls(str_manager):
+            dict_indices[fn_name] = multicall.add(contract_instance, fn_name)
 
-        # get token0 and token1
-        token_0 = contract_instance.functions.token0().call()
-        token_1 = contract_instance.functions.token1().call()
-        print("log: tokens of uni_pool retrieved")
+        return dict_indices
 
-        return token_0, token_1
+    def vault_state(self, str_pool, str_manager, str_contract, dict_indices, results):
+        """{function name: result} of the calls of a vault, raises MulticallError if one of them failed
+        and the error of queueing them if they were not queued"""
+        if isinstance(dict_indices, Exception):
+            raise dict_indices
+        return {fn_name: Multicall.check(results[index]) for fn_name, index in dict_indices.items()}
+
+    @classmethod
+    def vault_calls(cls, str_manager):
+        """distinct contract functions the spec of a manager reads, for its fields and the ticks of its positions"""
+        spec = cls.MANAGERS[str_manager]
+        paths = list(spec["fields"].values()) + [path for ticks in spec.get("positions", {}).values() for path in ticks]
+        return list(dict.fromkeys(fn_name for fn_name, *path in paths))
 
     def get_price(self, contract):
-        # initialize Coingecko API instance
-        cg = CoinGeckoAPI()
-        # get coingecko price for asset
-        cg_id = self.CONTRACTS[contract.lower()][0]
-        price = cg.get_price(ids=cg_id, vs_currencies='usd')[cg_id]['usd']
-        return price
-
-    def g_uni_vaults(self, pool_id, contract, token_0_contract, token_0_price, token_1_contract, token_1_price):
-        """ gets core information from g-uni contracts"""
-        # inits
-        abi_contract = Web3.toChecksumAddress("0xb542d5Cb34ef265fB87c170181127332f7797369")
-        contract = Web3.toChecksumAddress(contract)
-        contract_instance = self.bc.create_contract(contract_address=contract, abi_address=abi_contract)
-
-        # get data from contract
-        decimals = contract_instance.functions.decimals().call()
-        total_supply_wei = contract_instance.functions.totalSupply().call()
-        total_supply = total_supply_wei / (10 ** decimals)
-        # get necessary details for tokens
-        token_0_balance_wei, token_1_balance_wei = contract_instance.functions.getUnderlyingBalances().call()
-        token_0_balance = token_0_balance_wei / (10 ** self.CONTRACTS[token_0_contract.lower()][1])
-        token_1_balance = token_1_balance_wei / (10 ** self.CONTRACTS[token_1_contract.lower()][1])
-        token_0_value = token_0_balance * token_0_price
-        token_1_value = token_1_balance * token_1_price
-        vault_value = token_0_value + token_1_value
-        vault_token_price = vault_value / total_supply
-        upper_bound = contract_instance.functions.upperTick().call()
-        lower_bound = contract_instance.functions.lowerTick().call()
-        now = int(time.time())
-
-        return_dict = {
-            "timestamp": now,
-            "poolId": pool_id,
-            "manager": "g-uni",
-            "totalSupply": total_supply,
-            "token0Balance": token_0_balance,
-            "token0Contract": token_0_contract,
-            "token0Price": token_0_price,
-            "token0Value": token_0_value,
-            "token1Contract": token_1_contract,
-            "token1Balance": token_1_balance,
-            "token1Price": token_1_price,
-            "token1Value": token_1_value,
-            "vaultValue": vault_value,
-            "vaultTokenPrice": vault_token_price,
-            "upperBound": upper_bound,
-            "lowerBound": lower_bound,
-        }
-        print("log: queried g-uni vault for uni vault {}".format(pool_id))
-        return return_dict
-
-    def gamma_vaults(self, pool_id, contract, token_0_contract, token_0_price, token_1_contract, token_1_price):
-        """ gets core information from gamma contracts"""
-        # inits
-        contract = Web3.toChecksumAddress(contract)
-        contract_instance = self.bc.create_contract(contract_address=contract)
-
-        # get data from contract
-        decimals = contract_instance.functions.decimals().call()
-        total_supply_wei = contract_instance.functions.totalSupply().call()
-        total_supply = total_supply_wei / (10 ** decimals)
-        # get necessary details for tokens
-        token_0_balance_wei, token_1_balance_wei = contract_instance.functions.getTotalAmounts().call()
-        token_0_balance = token_0_balance_wei / (10 ** self.CONTRACTS[token_0_contract.lower()][1])
-        token_1_balance = token_1_balance_wei / (10 ** self.CONTRACTS[token_1_contract.lower()][1])
-        token_0_value = token_0_balance * token_0_price
-        token_1_value = token_1_balance * token_1_price
-        vault_value = token_0_value + token_1_value
-        vault_token_price = vault_value / total_supply
-        upper_bound = contract_instance.functions.baseUpper().call()
-        lower_bound = contract_instance.functions.baseLower().call()
-        now = int(time.time())
-
-        return_dict = {
-            "timestamp": now,
-            "poolId": pool_id,
-            "manager": "gamma",
-            "totalSupply": total_supply,
-            "token0Balance": token_0_balance,
-            "token0Contract": token_0_contract,
-            "token0Price": token_0_price,
-            "token0Value": token_0_value,
-            "token1Contract": token_1_contract,
-            "token1Balance": token_1_balance,
-            "token1Price": token_1_price,
-            "token1Value": token_1_value,
-            "vaultValue": vault_value,
-            "vaultTokenPrice": vault_token_price,
-            "upperBound": upper_bound,
-            "lowerBound": lower_bound,
-        }
-        print("log: queried gamma vault for uni vault {}".format(pool_id))
-        return return_dict
-
-    def lixir_vaults(self, pool_id, contract, token_0_contract, token_0_price, token_1_contract, token_1_price):
-        """ gets core information from lixir contracts"""
-        # inits
-        contract = Web3.toChecksumAddress(contract)
-        contract_instance = self.bc.create_contract(contract_address=contract)
-
-        # get data from contract
-        decimals = contract_instance.functions.decimals().call()
-        total_supply_wei = contract_instance.functions.totalSupply().call()
-        total_supply = total_supply_wei / (10 ** decimals)
-        # get necessary details for tokens
-        token_0_balance_wei, token_1_balance_wei, q1, q2 = contract_instance.functions.calculateTotals().call()
-        token_0_balance = token_0_balance_wei / (10 ** self.CONTRACTS[token_0_contract.lower()][1])
-        token_1_balance = token_1_balance_wei / (10 ** self.CONTRACTS[token_1_contract.lower()][1])
-        token_0_value = token_0_balance * token_0_price
-        token_1_value = token_1_balance * token_1_price
-        vault_value = token_0_value + token_1_value
-        vault_token_price = vault_value / total_supply
-        lower_bound, upper_bound = contract_instance.functions.mainPosition().call()
-        now = int(time.time())
-
-        return_dict = {
-            "timestamp": now,
-            "poolId": pool_id,
-            "manager": "lixir",
-            "totalSupply": total_supply,
-            "token0Balance": token_0_balance,
-            "token0Contract": token_0_contract,
-            "token0Price": token_0_price,
-            "token0Value": token_0_value,
-            "token1Contract": token_1_contract,
-            "token1Balance": token_1_balance,
-            "token1Price": token_1_price,
-            "token1Value": token_1_value,
-            "vaultValue": vault_value,
-            "vaultTokenPrice": vault_token_price,
-            "upperBound": upper_bound,
-            "lowerBound": lower_bound,
-        }
-        print("log: queried lixir vault for uni vault {}".format(pool_id))
-        return return_dict
-
-    def charm_vaults(self, pool_id, contract, token_0_contract, token_0_price, token_1_contract, token_1_price):
-        """ gets core information from charm contracts"""
-        # inits
-        contract = Web3.toChecksumAddress(contract)
-        contract_instance = self.bc.create_contract(contract_address=contract)
-
-        # get data from contract
-        decimals = contract_instance.functions.decimals().call()
-        total_supply_wei = contract_instance.functions.totalSupply().call()
-        total_supply = total_supply_wei / (10 ** decimals)
-        # get necessary details for tokens
-        token_0_balance_wei, token_1_balance_wei= contract_instance.functions.getTotalAmounts().call()
-        token_0_balance = token_0_balance_wei / (10 ** self.CONTRACTS[token_0_contract.lower()][1])
-        token_1_balance = token_1_balance_wei / (10 ** self.CONTRACTS[token_1_contract.lower()][1])
-        token_0_value = token_0_balance * token_0_price
-        token_1_value = token_1_balance * token_1_price
-        vault_value = token_0_value + token_1_value
-        vault_token_price = vault_value / total_supply
-        lower_bound = contract_instance.functions.baseLower().call()
-        upper_bound = contract_instance.functions.baseUpper().call()
-        now = int(time.time())
-
-        return_dict = {
-            "timestamp": now,
-            "poolId": pool_id,
-            "manager": "charm",
-            "totalSupply": total_supply,
-            "token0Balance": token_0_balance,
-            "token0Contract": token_0_contract,
-            "token0Price": token_0_price,
-            "token0Value": token_0_value,
-            "token1Contract": token_1_contract,
-            "token1Balance": token_1_balance,
-            "token1Price": token_1_price,
-            "token1Value": token_1_value,
-            "vaultValue": vault_value,
-            "vaultTokenPrice": vault_token_price,
-            "upperBound": upper_bound,
-            "lowerBound": lower_bound,
-        }
-        print("log: queried charm vault for uni vault {}".format(pool_id))
-        return return_dict
-
-    def popsicle_vaults(self, pool_id, contract, token_0_contract, token_0_price, token_1_contract, token_1_price):
-        """ gets core information from charm contracts"""
-        # inits
-        contract = Web3.toChecksumAddress(contract)
-        contract_instance = self.bc.create_contract(contract_address=contract)
-
-        # get data from contract
-        decimals = contract_instance.functions.decimals().call()
-        total_supply_wei = contract_instance.functions.totalSupply().call()
-        total_supply = total_supply_wei / (10 ** decimals)
-        # get necessary details for tokens
-        token_0_balance_wei, token_1_balance_wei = contract_instance.functions.usersAmounts().call()
-        token_0_balance = token_0_balance_wei / (10 ** self.CONTRACTS[token_0_contract.lower()][1])
-        token_1_balance = token_1_balance_wei / (10 ** self.CONTRACTS[token_1_contract.lower()][1])
-        token_0_value = token_0_balance * token_0_price
-        token_1_value = token_1_balance * token_1_price
-        vault_value = token_0_value + token_1_value
-        vault_token_price = vault_value / total_supply
-        lower_bound = contract_instance.functions.tickLower().call()
-        upper_bound = contract_instance.functions.tickUpper().call()
-        now = int(time.time())
-
-        return_dict = {
-            "timestamp": now,
-            "poolId": pool_id,
-            "manager": "popsicle",
-            "totalSupply": total_supply,
-            "token0Balance": token_0_balance,
-            "token0Contract": token_0_contract,
-            "token0Price": token_0_price,
-            "token0Value": token_0_value,
-            "token1Contract": token_1_contract,
-            "token1Balance": token_1_balance,
-            "token1Price": token_1_price,
-            "token1Value": token_1_value,
-            "vaultValue": vault_value,
-            "vaultTokenPrice": vault_token_price,
-            "upperBound": upper_bound,
-            "lowerBound": lower_bound,
-        }
-        print("log: queried popsicle vault for uni vault {}".format(pool_id))
-        return return_dict
+        # get cached or freshly fetched price for asset
+        return self.oracle.get_price(contract)
+
+    def vault_row(self, snapshot, pool_id, manager, contract, token_0_contract, token_0_decimals, token_0_price,
+                  token_1_contract, token_1_decimals, token_1_price, state, timestamp=None):
+        """ writes core information of a vault from its queried contract state, decoded by the manager's spec,
+        into the snapshot and returns its row index. Amounts stay raw integers here, build_df converts them
+        for all vaults at once"""
+        # decode fields of the manager spec from contract state
+        fields = self.decode_fields(manager, state)
+        now = int(time.time()) if timestamp is None else timestamp
+
+        index = snapshot.add(
+            timestamp=now,
+            poolId=pool_id,
+            manager=manager,
+            chain=self.chain,
+            token0Contract=token_0_contract,
+            token0Price=token_0_price,
+            token1Contract=token_1_contract,
+            token1Price=token_1_price,
+            upperBound=fields["upperBound"],
+            lowerBound=fields["lowerBound"],
+            totalSupplyRaw=str(fields["totalSupply"]),
+            token0BalanceRaw=str(fields["token0Balance"]),
+            token1BalanceRaw=str(fields["token1Balance"]),
+            vaultDecimals=fields["decimals"],
+            token0Decimals=token_0_decimals,
+            token1Decimals=token_1_decimals,
+            status="ok",
+        )
+        print("log: queried {} vault for uni vault {}".format(manager, pool_id))
+        return index
+
+    @staticmethod
+    def pick(state, fn_name, *path):
+        """the value at an index path into the result of a call"""
+        value = state[fn_name]
+        for index in path:
+            value = value[index]
+        return value
+
+    def decode_fields(self, manager, state):
+        """picks every field of the manager spec out of the call results, following its index path"""
+        return {field: self.pick(state, *path) for field, path in self.MANAGERS[manager]["fields"].items()}
+
+    @classmethod
+    def decode_positions(cls, manager, state):
+        """(name, lower tick, upper tick) of every position of the manager spec, positions given as arrays
+        of ticks are numbered"""
+        ticks = []
+        for name, (lower_path, upper_path) in cls.MANAGERS[manager].get("positions", {}).items():
+            lower, upper = cls.pick(state, *lower_path), cls.pick(state, *upper_path)
+            if isinstance(lower, (list, tuple)):
+                ticks.extend(("{}_{}".format(name, index), tick_lower, tick_upper)
+                             for index, (tick_lower, tick_upper) in enumerate(zip(lower, upper)))
+            else:
+                ticks.append((name, lower, upper))
+        return ticks
+
+
+class MultiChainQuery:
+    """Collects the pools of every chain of the config in parallel, one query (of query_class, e.g. Query or
+    IncrementalQuery) per chain with the chain's own endpoints, explorer and caches. The snapshots are combined
+    into one dataframe with the chain column. A chain whose run fails or does not finish within TIMEOUT seconds
+    becomes error rows for its vaults, so that a slow L2 endpoint never holds up the others. A chain whose
+    previous run is still in progress is not run again and becomes error rows as well, so that runs of a
+    chain never overlap"""
+
+    TIMEOUT = 300
+
+    def __init__(self, config, query_class=Query, timeout=None, **kwargs):
+        self.queries = {chain: query_class(config, chain=chain, **kwargs) for chain in Query.chains(config)}
+        self.timeout = timeout or self.TIMEOUT
+        # {chain: future} of the last run of every chain, runs over the timeout finish in the background
+        self.running = {}
+
+    def compile(self, pools=None):
+        """runs all chains which have some of the given pools (all pools by default)"""
+        queries = {chain: chain_query for chain, chain_query in self.queries.items() if chain_query.vaults(pools)}
+        busy = {chain for chain in queries if chain in self.running and not self.running[chain].done()}
+        # the executor is not waited for, threads of chains over the timeout finish in the background
+        executor = ThreadPoolExecutor(max_workers=max(len(queries) - len(busy), 1))
+        futures = {chain: executor.submit(chain_query.compile, pools=pools)
+                   for chain, chain_query in queries.items() if chain not in busy}
+        self.running.update(futures)
+        wait(futures.values(), timeout=self.timeout)
+        executor.shutdown(wait=False)
 
+        dfs = []
+        for chain in queries:
+            future = futures.get(chain)
+            if future is None:
+                error = RuntimeError("previous run on {} still in progress".format(chain))
+            elif not future.done():
+                error = TimeoutError("{} not collected within {}s".format(chain, self.timeout))
+            else:
+                error = future.exception()
+            if error is None:
+                dfs.append(future.result())
+                continue
+            print("log: collection on {} failed ({!r})".format(chain, error))
+            dfs.append(queries[chain].failed(error, pools))
+        # categories of the chains differ, concat unifies them
+        return schema.apply(pd.concat(dfs, ignore_index=True)) if dfs else schema.Snapshot(0).to_df()
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+from collections import Counter
+from urllib.parse import urlencode
+
+import pandas as pd
+import requests
+
+import helper
+import oracle
+import query
+import storage
+from fake_rpc import LocalServer, label, point_to
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(ROOT_DIR, 'query_config.json')
+
+# the real google sheets client, replay servers stand in for it
+SHEETS = helper.Sheets
+
+
+class Fixture:
+    """Recorded interactions, {request key: [responses in the order they were received]}, stored as JSON.
+    Replaying serves the responses of a key in the same order and repeats the last one once they are used up.
+    Keys are the JSON-RPC method and params, the path and query of GET requests without the api key,
+    or the sheet and method of a google sheets read"""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                self.interactions = json.load(f)
+        except FileNotFoundError:
+            self.interactions = {}
+        self.served = Counter()
+        self.misses = []
+
+    @staticmethod
+    def rpc_key(payload):
+        return "rpc " + json.dumps([payload["method"], payload.get("params", [])], sort_keys=True)
+
+    @staticmethod
+    def get_key(path, query):
+        return "GET {}?{}".format(path, urlencode(sorted(
+            (name, value) for name, values in query.items() if name != "apikey" for value in values)))
+
+    def add(self, key, response):
+        self.interactions.setdefault(key, []).append(response)
+        return
+
+    def get(self, key):
+        if key not in self.interactions:
+            self.misses.append(key)
+            raise KeyError(key)
+        responses = self.interactions[key]
+        response = responses[min(self.served[key], len(responses) - 1)]
+        self.served[key] += 1
+        return response
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        helper.write_atomic(self.path, json.dumps(self.interactions, indent=1, sort_keys=True))
+        print("log: {} recorded interactions written to {}".format(
+            sum(len(responses) for responses in self.interactions.values()), self.path))
+        return
+
+
+class ReplayServer(LocalServer):
+    """Serves the JSON-RPC, etherscan and CoinGecko interactions of a fixture, with the latency and error
+    injection of LocalServer. Given upstreams ({"rpc": [urls], "etherscan": url, "coingecko": url}) it records
+    instead: requests are forwarded upstream and their responses added to the fixture, rate limited and failed
+    requests are passed on without being recorded. Unrecorded requests of a replay fail like a node or API would"""
+
+    def __init__(self, fixture, upstreams=None, latency=0.0, error_rate=0.0, error_methods=None, seed=0):
+        super().__init__(latency=latency, error_rate=error_rate, error_methods=error_methods, seed=seed)
+        self.fixture = fixture
+        self.upstreams = upstreams
+        self.session = requests.Session()
+
+    @property
+    def recording(self):
+        return self.upstreams is not None
+
+    # JSON-RPC handling
+    def handle_rpc(self, payload):
+        if isinstance(payload, list):
+            self.record("batch")
+            return [self.handle_rpc_call(item) for item in payload]
+        return self.handle_rpc_call(payload)
+
+    def handle_rpc_call(self, payload):
+        self.record(payload["method"])
+        key = self.fixture.rpc_key(payload)
+        if self.recording:
+            try:
+                body = self.forward_rpc(payload)
+            except requests.RequestException as e:
+                return {"error": str(e)}, 503
+            entry = {field: body[field] for field in ("result", "error") if field in body}
+            with self.lock:
+                self.fixture.add(key, entry)
+        else:
+            try:
+                with self.lock:
+                    entry = self.fixture.get(key)
+            except KeyError:
+                entry = {"error": {"code": -32000, "message": "request not recorded"}}
+        return dict(entry, jsonrpc="2.0", id=payload.get("id"))
+
+    def forward_rpc(self, payload):
+        """posts to the first upstream endpoint that answers"""
+        error = None
+        for endpoint in self.upstreams["rpc"]:
+            try:
+                response = self.session.post(endpoint, json=payload, timeout=helper.Blockchain.TIMEOUT)
+                response.raise_for_status()
+                return response.json()
+            except requests.RequestException as e:
+                error = e
+        raise error
+
+    # etherscan and coingecko handling
+    def handle_get(self, path, query):
+        self.record(label(path, query))
+        key = self.fixture.get_key(path, query)
+        if self.recording:
+            if path.startswith("/coingecko/"):
+                url = self.upstreams["coingecko"] + path[len("/coingecko/"):]
+            else:
+                url = self.upstreams["etherscan"]
+            try:
+                response = self.session.get(url, params=query, timeout=helper.Blockchain.TIMEOUT)
+            except requests.RequestException as e:
+                return {"error": str(e)}, 503
+            try:
+                body = response.json()
+            except ValueError:
+                body = {"error": response.text}
+            if response.status_code == 429 or response.status_code >= 500:
+                return body, response.status_code
+            with self.lock:
+                self.fixture.add(key, {"status": response.status_code, "body": body})
+            return body, response.status_code
+        try:
+            with self.lock:
+                entry = self.fixture.get(key)
+        except KeyError:
+            return {"error": "request not recorded"}, 404
+        return entry["body"], entry["status"]
+
+    # google sheets
+    def sheets(self, sheet_name):
+        return ReplaySheets(self, sheet_name)
+
+    def install(self):
+        """routes all traffic to the server, replaces the google sheets client and isolates all caches,
+        so that a run neither depends on nor changes local state"""
+        point_to(self)
+        if self.recording:
+            helper.EvmAPI.API_DICT["ethereum"][1] = self.upstreams.get("etherscan_key")
+        helper.ABI_STORE = helper.AbiStore(cache_dir=tempfile.mkdtemp())
+        helper.Blockchain.reset()
+        helper.Sheets = self.sheets
+        return self
+
+
+class ReplaySheets:
+    """Stand-in for helper.Sheets. Reads are answered from the fixture, or while recording from the real sheet
+    and added to the fixture. Appended rows never reach the real sheet, they are kept in memory so that
+    later reads see them"""
+
+    def __init__(self, server, sheet_name):
+        self.server = server
+        self.sheet_name = sheet_name
+        self.sheet = SHEETS(sheet_name).sheet if server.recording else None
+        self.header = None
+        self.appended = []
+
+    def read(self, method, argument, function):
+        self.server.record("sheets/" + method)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.inject_error("sheets/" + method):
+            raise requests.ConnectionError("injected google sheets error")
+        key = "sheets {} {} {}".format(self.sheet_name, method, argument)
+        if self.sheet is not None:
+            value = function()
+            self.server.fixture.add(key, value)
+            return value
+        return self.server.fixture.get(key)
+
+    def get_df(self):
+        records = self.read("get_all_records", "", lambda: self.sheet.get_all_records())
+        return pd.concat([pd.DataFrame(records)] + self.appended, ignore_index=True)
+
+    def get_header(self):
+        if self.header is None:
+            self.header = self.read("row_values", 1, lambda: self.sheet.row_values(1))
+        return self.header
+
+    def get_columns(self, columns):
+        header = self.get_header()
+        stored = {column: self.read("col_values", column, lambda: self.sheet.col_values(header.index(column) + 1)[1:])
+                  for column in columns}
+        return pd.concat([pd.DataFrame(stored)] + [df[columns].astype(str) for df in self.appended],
+                         ignore_index=True)
+
+    def append_df(self, df):
+        self.server.record("sheets/append_rows")
+        self.header = self.get_header() + [column for column in df.columns if column not in self.get_header()]
+        self.appended.append(df)
+        print("log: {} rows appended to replayed google sheet".format(len(df)))
+        return
+
+
+def live_upstreams():
+    """the endpoints the client would reach without the server in between"""
+    return {
+        "rpc": helper.Blockchain("Ethereum").get_endpoints(),
+        "etherscan": helper.EvmAPI.API_DICT["ethereum"][0],
+        "etherscan_key": helper.EvmAPI.API_DICT["ethereum"][1],
+        "coingecko": oracle.CoinGeckoSource.API_URL,
+    }
+
+
+def run(config, server):
+    """one collection run through the server: compile the snapshot and append it to the configured sheet"""
+    start = time.perf_counter()
+    df = query.Query(config).compile()
+    storage.SheetsStorage(config.get('storage', {}).get('sheet_name', 'v3-optimizer-data')).append(df)
+    duration = time.perf_counter() - start
+    print("log: run of {} vaults took {:.3f}s, {} requests ({} failed by injection), {} not recorded: {}".format(
+        len(df), duration, len(server.requests), server.errors, len(server.fixture.misses),
+        dict(Counter(server.requests))))
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="record a collection run into a fixture or replay it offline")
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("fixture", help="JSON file the interactions are recorded into or replayed from")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every response is delayed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failed on purpose")
+    parser.add_argument("--error-methods", nargs="+", metavar="METHOD",
+                        help="fail only requests of these methods, e.g. eth_call getabi simple/price sheets/col_values")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the error injection")
+    args = parser.parse_args()
+
+    with open(CONFIG_PATH, 'r') as f:
+        config = json.load(f)
+    upstreams = live_upstreams() if args.mode == "record" else None
+    if upstreams is None and not os.path.exists(args.fixture):
+        parser.error("fixture {} not found".format(args.fixture))
+    fixture = Fixture(args.fixture)
+    server = ReplayServer(fixture, upstreams, latency=args.latency, error_rate=args.error_rate,
+                          error_methods=args.error_methods, seed=args.seed).start()
+    server.install()
+    try:
+        run(config, server)
+    finally:
+        server.stop()
+    if args.mode == "record":
+        fixture.save()
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import time
+import signal
+import threading
+
+import pandas as pd
+
+import query
+import incremental
+import storage
+from telemetry import TELEMETRY
+
+
+class Scheduler:
+    """Resident scheduler which collects snapshots in a loop instead of one run per process start.
+    Providers, ABI and price caches and the storage handle stay warm between ticks. Every pool has its own
+    cadence (optional 'schedule' key of the config, e.g. {"interval": 3600, "pools": {"usdc_usdt_0.01": 21600}}),
+    a tick collects all pools that are due in one run. Runs never overlap: slots missed while a run was busy
+    are skipped. Rows that could not be written stay buffered and are flushed on the next tick or on shutdown.
+    Every tick ends its telemetry run, i.e. writes a summary and refreshes the Prometheus export at metrics_path.
+    The pools of all chains of the config are collected in parallel by one MultiChainQuery.
+    In incremental mode only vaults with events since their last read are re-read, with ws_urls ({chain: url})
+    the events are collected through websocket subscriptions between the ticks"""
+
+    INTERVAL = 3600
+
+    def __init__(self, config, interval=None, backend=None, metrics_path=None, incremental_mode=False, ws_urls=None):
+        schedule = config.get('schedule', {})
+        self.interval = interval or schedule.get('interval', self.INTERVAL)
+        self.cadences = {str_pool: schedule.get('pools', {}).get(str_pool, self.interval)
+                         for str_pool in config['query']}
+        self.ws_urls = ws_urls or {}
+        self.query = query.MultiChainQuery(
+            config, incremental.IncrementalQuery if incremental_mode or self.ws_urls else query.Query)
+        self.backend = backend or storage.get_storage(config)
+        self.next_runs = {str_pool: 0 for str_pool in self.cadences}
+        self.buffer = []
+        self.metrics_path = metrics_path
+        self.stopping = threading.Event()
+
+    def due(self, now):
+        return [str_pool for str_pool, next_run in self.next_runs.items() if next_run <= now]
+
+    def tick(self, now=None):
+        """collects all due pools, then schedules each of them for the next slot of its cadence after the run"""
+        now = now or time.time()
+        pools = self.due(now)
+        if not pools:
+            return
+        try:
+            with TELEMETRY.span("tick"):
+                self.buffer.append(self.query.compile(pools=pools))
+        except Exception as e:
+            print("log: run for {} failed ({})".format(", ".join(pools), e))
+        finished = time.time()
+        for str_pool in pools:
+            cadence = self.cadences[str_pool]
+            next_run = (now // cadence + 1) * cadence
+            if next_run <= finished:
+                skipped = int((finished - next_run) // cadence) + 1
+                print("log: run for {} took longer than its cadence, skipping {} slots".format(str_pool, skipped))
+                next_run += skipped * cadence
+            self.next_runs[str_pool] = next_run
+        with TELEMETRY.span("phase", phase="save"):
+            self.flush()
+        TELEMETRY.finish(prometheus_path=self.metrics_path)
+        return
+
+    def flush(self):
+        if not self.buffer:
+            return
+        try:
+            self.backend.append(pd.concat(self.buffer, ignore_index=True))
+            self.buffer = []
+        except Exception as e:
+            print("log: writing {} buffered rows failed, retrying later ({})".format(
+                sum(len(df) for df in self.buffer), e))
+        return
+
+    def stop(self, signum=None, frame=None):
+        print("log: scheduler stopping")
+        self.stopping.set()
+        return
+
+    def run(self):
+        """ticks until SIGTERM/SIGINT (or stop()), then flushes buffered rows and closes the storage"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print("log: scheduler started with cadences {}".format(self.cadences))
+        for chain, ws_url in self.ws_urls.items():
+            self.query.queries[chain].subscribe(ws_url)
+        while not self.stopping.is_set():
+            self.tick()
+            self.stopping.wait(max(0, min(self.next_runs.values()) - time.time()))
+        for chain in self.ws_urls:
+            self.query.queries[chain].unsubscribe()
+        self.flush()
+        self.backend.close()
+        print("log: scheduler stopped")
+        return
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+# fixed type of every snapshot column: identifiers and errors are categorical, amounts float, ticks, decimals and
+# position counts nullable integers (rows of failed vaults have none), raw amounts strings as they exceed int64.
+# The position columns sum up all uni positions of a vault (positions.py)
+SCHEMA = {
+    "timestamp": "int64",
+    "poolId": "category",
+    "manager": "category",
+    "chain": "category",
+    "totalSupply": "float64",
+    "token0Balance": "float64",
+    "token0Contract": "category",
+    "token0Price": "float64",
+    "token0Value": "float64",
+    "token1Contract": "category",
+    "token1Balance": "float64",
+    "token1Price": "float64",
+    "token1Value": "float64",
+    "vaultValue": "float64",
+    "vaultTokenPrice": "float64",
+    "upperBound": "Int32",
+    "lowerBound": "Int32",
+    "positionCount": "UInt8",
+    "inRangeLiquidity": "float64",
+    "outOfRangeLiquidity": "float64",
+    "inRangeValue": "float64",
+    "outOfRangeValue": "float64",
+    "inRangeShare": "float64",
+    "uncollectedFees0": "float64",
+    "uncollectedFees1": "float64",
+    "uncollectedFeesValue": "float64",
+    "totalSupplyRaw": "string",
+    "token0BalanceRaw": "string",
+    "token1BalanceRaw": "string",
+    "vaultDecimals": "UInt8",
+    "token0Decimals": "UInt8",
+    "token1Decimals": "UInt8",
+    "status": "category",
+    "error": "category",
+}
+COLUMNS = list(SCHEMA)
+# numpy types backing the integer columns
+INTEGERS = {"int64": np.int64, "Int32": np.int32, "UInt8": np.uint8}
+
+
+class Snapshot:
+    """Preallocated columnar buffer for the rows of one run. Rows are written into NumPy arrays of the
+    schema's types and turned into a typed dataframe without an inference pass"""
+
+    def __init__(self, size):
+        self.length = 0
+        self.arrays = {}
+        self.missing = {}
+        for column, dtype in SCHEMA.items():
+            if dtype == "float64":
+                self.arrays[column] = np.full(size, np.nan)
+            elif dtype in INTEGERS:
+                self.arrays[column] = np.zeros(size, dtype=INTEGERS[dtype])
+                self.missing[column] = np.ones(size, dtype=bool)
+            else:
+                self.arrays[column] = np.full(size, None, dtype=object)
+
+    def add(self, **values):
+        """writes a row and returns its index, columns not given stay missing"""
+        index = self.length
+        self.length += 1
+        self.set(index, **values)
+        return index
+
+    def set(self, index, **values):
+        """fills columns of a row written before"""
+        for column, value in values.items():
+            self.arrays[column][index] = value
+            if column in self.missing:
+                self.missing[column][index] = False
+        return
+
+    def column(self, column):
+        return self.arrays[column][:self.length]
+
+    def to_df(self):
+        columns = {}
+        for column, dtype in SCHEMA.items():
+            values = self.column(column)
+            if dtype in INTEGERS and dtype != "int64":
+                columns[column] = pd.arrays.IntegerArray(values, self.missing[column][:self.length].copy())
+            elif dtype in ("category", "string"):
+                columns[column] = pd.Series(values).astype(dtype)
+            else:
+                columns[column] = values
+        return pd.DataFrame(columns)
+
+
+def apply(df):
+    """casts a stored history, e.g. read back from SQLite or a sheet, to the schema with one explicit cast per column.
+    Columns the schema does not know are kept as they are"""
+    df = df.copy()
+    for column, dtype in SCHEMA.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        values = df[column]
+        if values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            # sheets return empty cells as empty strings
+            values = values.replace("", np.nan)
+            if dtype == "float64" or dtype in INTEGERS:
+                values = pd.to_numeric(values, errors='coerce')
+        df[column] = values.astype(dtype)
+    return df
@@ -0,0 +1,117 @@
+import os
+import sqlite3
+
+import pandas as pd
+
+import helper
+import schema
+from telemetry import TELEMETRY
+
+# every snapshot row is identified by these columns, rows with a known key are skipped so that retries are idempotent
+KEY = ["timestamp", "poolId", "manager"]
+
+
+class Storage:
+    """Base class of the storage backends, which only ever append the new rows of a run"""
+
+    def append(self, df):
+        """appends the rows of df whose key is not stored yet and returns the number of appended rows"""
+        raise NotImplementedError
+
+    def read(self):
+        """returns the full stored history as a dataframe with the types of the schema"""
+        raise NotImplementedError
+
+    def close(self):
+        return
+
+
+class SheetsStorage(Storage):
+    """appends rows to a google sheet with append_rows, known keys are read from the key columns only"""
+
+    def __init__(self, sheet_name):
+        self.sheets = helper.Sheets(sheet_name)
+        self.keys = None
+
+    def append(self, df):
+        if self.keys is None:
+            if self.sheets.get_header():
+                stored = self.sheets.get_columns(KEY)
+                self.keys = set(zip(stored["timestamp"].astype(int), stored["poolId"], stored["manager"]))
+            else:
+                self.keys = set()
+        df = drop_known(df, self.keys)
+        if not df.empty:
+            self.sheets.append_df(df)
+            self.keys.update(zip(df["timestamp"].astype(int), df["poolId"], df["manager"]))
+        print("log: {} new rows written into google spreadsheet: {}".format(len(df), self.sheets.sheet_name))
+        return len(df)
+
+    def read(self):
+        return schema.apply(self.sheets.get_df())
+
+
+class SqliteStorage(Storage):
+    """local SQLite store with (timestamp, poolId, manager) as primary key,
+    columns the dataframe gains over time are added to the table on the fly"""
+
+    PATH = os.path.join(helper.ROOT_DIR, 'collected_data.sqlite')
+    TABLE = "snapshots"
+
+    def __init__(self, path=None):
+        self.path = path or self.PATH
+        self.connection = sqlite3.connect(self.path)
+
+    def columns(self):
+        return [row[1] for row in self.connection.execute("PRAGMA table_info({})".format(self.TABLE))]
+
+    def prepare(self, df):
+        """creates the table or adds columns of df which it does not have yet"""
+        columns = self.columns()
+        if not columns:
+            definitions = ", ".join('"{}"'.format(column) for column in df.columns)
+            self.connection.execute('CREATE TABLE {} ({}, PRIMARY KEY ({}))'.format(
+                self.TABLE, definitions, ", ".join('"{}"'.format(column) for column in KEY)))
+        for column in df.columns:
+            if columns and column not in columns:
+                self.connection.execute('ALTER TABLE {} ADD COLUMN "{}"'.format(self.TABLE, column))
+        return
+
+    def append(self, df):
+        self.prepare(df)
+        df = df.drop_duplicates(subset=KEY)
+        rows = df.astype(object).where(df.notna(), None).values.tolist()
+        with self.connection, TELEMETRY.span("storage", backend="sqlite"):
+            cursor = self.connection.executemany('INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(
+                self.TABLE, ", ".join('"{}"'.format(column) for column in df.columns),
+                ", ".join("?" for column in df.columns)), rows)
+        print("log: {} new rows written into {}".format(cursor.rowcount, self.path))
+        TELEMETRY.count("storage_rows_written", cursor.rowcount, backend="sqlite")
+        return cursor.rowcount
+
+    def read(self):
+        if not self.columns():
+            return pd.DataFrame()
+        return schema.apply(pd.read_sql_query("SELECT * FROM {}".format(self.TABLE), self.connection))
+
+    def close(self):
+        self.connection.close()
+        return
+
+
+def drop_known(df, keys):
+    """drops rows whose key is in keys as well as duplicates within df"""
+    df = df.drop_duplicates(subset=KEY)
+    known = [key in keys for key in zip(df["timestamp"].astype(int), df["poolId"], df["manager"])]
+    return df[[not is_known for is_known in known]]
+
+
+def get_storage(config):
+    """returns the backend configured under the optional 'storage' key of the config, google sheets by default"""
+    storage_config = config.get('storage', {})
+    backend = storage_config.get('backend', 'sheets')
+    if backend == 'sheets':
+        return SheetsStorage(storage_config.get('sheet_name', 'v3-optimizer-data'))
+    if backend == 'sqlite':
+        return SqliteStorage(storage_config.get('path'))
+    raise ValueError("unknown storage backend {}".format(backend))
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Telemetry:
+    """Timing spans and counters of a run, labelled e.g. by phase or by endpoint and method of an external call.
+    Spans record count, total and max seconds, counters plain sums (calls, bytes, retries, cache hits).
+    A run ends with a JSON summary and optionally a Prometheus text format export, after which it starts over"""
+
+    SUMMARY_DIR = os.path.join(ROOT_DIR, '.telemetry')
+    PREFIX = "v3_manager_"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.spans = {}
+            self.counters = {}
+        return
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    @contextmanager
+    def span(self, name, **labels):
+        """times the enclosed block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            key = self.key(name, labels)
+            with self.lock:
+                count, total, maximum = self.spans.get(key, (0, 0.0, 0.0))
+                self.spans[key] = (count + 1, total + duration, max(maximum, duration))
+
+    def count(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        return
+
+    def summary(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "spans": [{"name": name, "labels": dict(labels), "count": count, "seconds": total, "max": maximum}
+                          for (name, labels), (count, total, maximum) in sorted(self.spans.items())],
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+            }
+
+    def prometheus(self):
+        """summary in the Prometheus text exposition format, e.g. for node_exporter's textfile collector"""
+        summary = self.summary()
+        # samples of one metric have to follow its TYPE line without other metrics in between
+        families = {}
+
+        def add(metric, kind, labels, value):
+            label_string = ",".join('{}="{}"'.format(label, str(label_value).replace('"', '\\"'))
+                                    for label, label_value in labels.items())
+            families.setdefault(metric, ["# TYPE {} {}".format(metric, kind)]).append(
+                "{}{{{}}} {}".format(metric, label_string, value) if label_string else "{} {}".format(metric, value))
+
+        for span in summary["spans"]:
+            labels = dict(span["labels"], span=span["name"])
+            add(self.PREFIX + "span_seconds_total", "counter", labels, span["seconds"])
+            add(self.PREFIX + "span_count_total", "counter", labels, span["count"])
+            add(self.PREFIX + "span_seconds_max", "gauge", labels, span["max"])
+        for counter in summary["counters"]:
+            add(self.PREFIX + counter["name"] + "_total", "counter", counter["labels"], counter["value"])
+        add(self.PREFIX + "run_duration_seconds", "gauge", {}, summary["duration"])
+        return "\n".join(line for lines in families.values() for line in lines) + "\n"
+
+    def finish(self, summary_path=None, prometheus_path=None):
+        """writes the run's JSON summary (into SUMMARY_DIR by default) and optionally its Prometheus export,
+        then starts a new run. Returns the summary path"""
+        if summary_path is None:
+            os.makedirs(self.SUMMARY_DIR, exist_ok=True)
+            summary_path = os.path.join(self.SUMMARY_DIR, 'run_{}.json'.format(int(self.started)))
+        with open(summary_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        if prometheus_path is not None:
+            # imported here, helper itself reports to the telemetry
+            import helper
+            # the textfile collector must never read half a file
+            helper.write_atomic(prometheus_path, self.prometheus())
+        print("log: run summary written to {}".format(summary_path))
+        self.reset()
+        return summary_path
+
+
+TELEMETRY = Telemetry()
@@ -0,0 +1,112 @@
+import os
+import json
+
+from pycoingecko import CoinGeckoAPI
+from web3 import Web3
+
+import helper
+import oracle
+from multicall import Multicall, CallFailure
+from telemetry import TELEMETRY
+
+
+class TokenRegistry:
+    """Token metadata in the format of contracts.json, {lowercase address: [coingecko id, decimals]}.
+    Tokens missing from contracts.json and the local cache are resolved on first sight: decimals with one batch
+    of on-chain decimals() calls, coingecko ids through coingecko's contract address lookup. Results are
+    persisted, so that a new pool in query_config.json needs no manual edits and costs no latency afterwards.
+    Tokens coingecko does not list are kept with a null id and priced from uni pools only. Tokens whose id lookup
+    failed for another reason are kept with their decimals and a null id as well, their lookup is retried on
+    later runs.
+    Every chain has its own registry, cache and seed file (contracts_<chain>.json besides ethereum)"""
+
+    CACHE_PATH = os.path.join(helper.ROOT_DIR, '.token_cache.json')
+    SEED_PATH = os.path.join(helper.ROOT_DIR, 'contracts.json')
+    ERC20_ABI = [{"type": "function", "name": "decimals", "inputs": [],
+                  "outputs": [{"name": "", "type": "uint8"}], "stateMutability": "view"}]
+    # coingecko asset platform of each chain
+    PLATFORMS = {"ethereum": "ethereum", "polygon": "polygon-pos", "arbitrum": "arbitrum-one",
+                 "optimism": "optimistic-ethereum"}
+
+    def __init__(self, bc, cache_path=None, seed_path=None):
+        self.bc = bc
+        self.cache_path = cache_path or helper.chain_path(self.CACHE_PATH, bc.blockchain)
+        # tokens whose coingecko id is still to be looked up, next to the cache
+        root, extension = os.path.splitext(self.cache_path)
+        self.pending_path = root + '_pending' + extension
+        self.tokens = {}
+        for path in (seed_path or helper.chain_path(self.SEED_PATH, bc.blockchain), self.cache_path):
+            try:
+                with open(path, 'r') as f:
+                    self.tokens.update(json.load(f))
+            except FileNotFoundError:
+                continue
+        try:
+            with open(self.pending_path, 'r') as f:
+                self.pending = set(json.load(f))
+        except FileNotFoundError:
+            self.pending = set()
+
+    def resolve(self, tokens):
+        """makes sure decimals and coingecko ids of the given tokens are known and returns their entries"""
+        tokens = sorted(set(token.lower() for token in tokens))
+        missing = [token for token in tokens if token not in self.tokens]
+        TELEMETRY.count("token_lookups", len(tokens) - len(missing), result="hit")
+        TELEMETRY.count("token_lookups", len(missing), result="miss")
+        pending = [token for token in tokens if token in self.pending]
+        if missing or pending:
+            decimals = self.get_decimals(missing) if missing else {}
+            ids = self.get_ids([token for token in missing if token in decimals] + pending)
+            for token in missing:
+                if token not in decimals:
+                    print("log: decimals of token {} unavailable".format(token))
+                    continue
+                # decimals are enough for the pool metadata, a missing id only keeps coingecko from pricing it
+                self.tokens[token] = [ids.get(token), decimals[token]]
+                if token not in ids:
+                    self.pending.add(token)
+            for token in pending:
+                if token in ids:
+                    self.tokens[token][0] = ids[token]
+                    self.pending.discard(token)
+            helper.write_atomic(self.cache_path, json.dumps(self.tokens, indent=2))
+            helper.write_atomic(self.pending_path, json.dumps(sorted(self.pending)))
+            print("log: {} new tokens resolved, coingecko ids of {} tokens pending".format(
+                len([token for token in missing if token in self.tokens]), len(self.pending)))
+        return {token: self.tokens[token] for token in tokens if token in self.tokens}
+
+    def get_decimals(self, tokens):
+        """reads decimals() of all tokens in one batch and returns {lowercase token: decimals}"""
+        w3 = self.bc.get_w3()
+        multicall = Multicall(w3)
+        indices = {token.lower(): multicall.add(
+            w3.eth.contract(address=Web3.toChecksumAddress(token), abi=self.ERC20_ABI), "decimals")
+            for token in tokens}
+        results = multicall.execute()
+        return {token: results[index] for token, index in indices.items()
+                if not isinstance(results[index], CallFailure)}
+
+    def get_ids(self, tokens):
+        """looks up the coingecko id of every token by its contract address, None for tokens coingecko does not list.
+        Tokens whose lookup failed otherwise are left out and retried on the next run"""
+        cg = CoinGeckoAPI()
+        cg.api_base_url = oracle.CoinGeckoSource.API_URL
+        cg.request_timeout = oracle.CoinGeckoSource.TIMEOUT
+        platform = self.PLATFORMS[self.bc.blockchain]
+        ids = {}
+        for token in tokens:
+            try:
+                with TELEMETRY.span("coingecko", method="coins/contract"):
+                    TELEMETRY.count("coingecko_requests", method="coins/contract")
+                    info = cg.get_coin_info_from_contract_address_by_id(id=platform, contract_address=token)
+            except ValueError as e:
+                # coingecko answers unknown contracts with 404 and an error message
+                if "not found" not in str(e).lower():
+                    print("log: coingecko id of {} unavailable ({})".format(token, e))
+                    continue
+                info = {}
+            except Exception as e:
+                print("log: coingecko id of {} unavailable ({})".format(token, e))
+                continue
+            ids[token] = info.get("id")
+        return ids